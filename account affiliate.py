@@ -0,0 +1,178 @@
+# accounts/affiliate.py
+#
+# Affiliate click-to-conversion attribution.
+# Clicks are logged raw, the affiliate code rides along in the session until
+# checkout, and an hourly job folds clicks + orders into AffiliateRollup.
+# Dashboards only ever read AffiliateRollup, so schedule the job hourly:
+#     5 * * * *  cd /srv/lumoskart && python manage.py rollup_affiliate_stats
+
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import (
+    AffiliateClick, AffiliateRelationship, AffiliateRollup, Order, OrderItem,
+    get_affiliate_links_version,
+)
+
+
+SESSION_KEY = 'affiliate_code'
+
+
+def record_click(request, relationship):
+    """
+    Log a click on an affiliate link and stamp its code into the session
+    so the order created at checkout can be attributed to it.
+    """
+    if not request.session.session_key:
+        request.session.save()
+
+    AffiliateClick.objects.create(
+        relationship=relationship,
+        session_key=request.session.session_key,
+    )
+    request.session[SESSION_KEY] = relationship.code
+
+
+def get_session_affiliate_code(request):
+    """Return the affiliate code stamped in the session, if any."""
+    return request.session.get(SESSION_KEY)
+
+
+def clear_session_affiliate_code(request):
+    if SESSION_KEY in request.session:
+        del request.session[SESSION_KEY]
+
+
+def get_affiliate_links(influencer_id):
+    """
+    Active affiliate links of an influencer, cached against the influencer's
+    version stamp. Any AffiliateRelationship write bumps the stamp, so stale
+    entries are never served and simply age out of the cache.
+    """
+    version = get_affiliate_links_version(influencer_id)
+    key = f'affiliate_links:{influencer_id}:{version}'
+
+    links = cache.get(key)
+    if links is None:
+        links = [
+            {
+                'product_id': relationship.product.id,
+                'product_name': relationship.product.name,
+                'affiliate_link': relationship.affiliate_link,
+            }
+            for relationship in AffiliateRelationship.objects.filter(
+                influencer_id=influencer_id,
+                is_active=True
+            ).select_related('product')
+        ]
+        cache.set(key, links, timeout=60 * 60 * 24)
+    return links
+
+
+def affiliate_links_etag(request, *args, **kwargs):
+    """ETag for the influencer's affiliate link JSON; computed from the cache only, no ORM work."""
+    if not request.user.is_authenticated or request.user.user_type != 'influencer':
+        return None
+    return f'{request.user.id}-{get_affiliate_links_version(request.user.id)}'
+
+
+def _floor_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_affiliate_stats(start=None, end=None):
+    """
+    Recompute AffiliateRollup rows for every hour in [start, end).
+    Defaults to the current hour and the two before it, so late-arriving orders are still picked up.
+    Safe to re-run: each (code, hour) row is overwritten, not incremented.
+    Run hourly by the rollup_affiliate_stats management command.
+    """
+    end = _floor_hour(end or timezone.now()) + timedelta(hours=1)
+    start = _floor_hour(start or end - timedelta(hours=3))
+
+    relationships = {
+        rel.code: rel
+        for rel in AffiliateRelationship.objects.only('code', 'influencer_id', 'product_id')
+    }
+
+    rows = {}
+
+    def row_for(code, hour):
+        key = (code, hour)
+        if key not in rows:
+            rel = relationships[code]
+            rows[key] = AffiliateRollup(
+                influencer_id=rel.influencer_id,
+                product_id=rel.product_id,
+                code=code,
+                hour=hour,
+                clicks=0,
+                orders=0,
+                revenue=Decimal('0.00'),
+            )
+        return rows[key]
+
+    clicks = (
+        AffiliateClick.objects
+        .filter(created_at__gte=start, created_at__lt=end)
+        .annotate(hour=TruncHour('created_at'))
+        .values('relationship__code', 'hour')
+        .annotate(total=Count('id'))
+    )
+    for entry in clicks:
+        if entry['relationship__code'] in relationships:
+            row_for(entry['relationship__code'], entry['hour']).clicks = entry['total']
+
+    # Grouped per product; only the affiliated product's lines count towards revenue
+    conversions = (
+        OrderItem.objects
+        .filter(
+            order__affiliate_code__isnull=False,
+            order__created_at__gte=start,
+            order__created_at__lt=end,
+        )
+        .exclude(order__status=Order.CANCELED)
+        .annotate(hour=TruncHour('order__created_at'))
+        .values('order__affiliate_code', 'product_id', 'hour')
+        .annotate(
+            orders=Count('order', distinct=True),
+            revenue=Sum(F('price') * F('quantity')),
+        )
+    )
+    for entry in conversions:
+        rel = relationships.get(entry['order__affiliate_code'])
+        if rel is None or rel.product_id != entry['product_id']:
+            continue
+        row = row_for(rel.code, entry['hour'])
+        row.orders = entry['orders']
+        row.revenue = entry['revenue'] or Decimal('0.00')
+
+    with transaction.atomic():
+        AffiliateRollup.objects.filter(hour__gte=start, hour__lt=end).delete()
+        AffiliateRollup.objects.bulk_create(rows.values())
+
+    return len(rows)
+
+
+def influencer_affiliate_summary(influencer, since=None):
+    """Clicks / orders / revenue totals for an influencer, read from the rollup table only."""
+    rollups = AffiliateRollup.objects.filter(influencer=influencer)
+    if since is not None:
+        rollups = rollups.filter(hour__gte=since)
+
+    totals = rollups.aggregate(
+        clicks=Sum('clicks'),
+        orders=Sum('orders'),
+        revenue=Sum('revenue'),
+    )
+    return {
+        'clicks': totals['clicks'] or 0,
+        'orders': totals['orders'] or 0,
+        'revenue': totals['revenue'] or Decimal('0.00'),
+    }
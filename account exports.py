@@ -0,0 +1,194 @@
+# accounts/exports.py
+#
+# Streaming exports for the admin. Rows are read with .iterator(chunk_size=...)
+# and written out as they are produced, so memory stays flat no matter how many
+# orders are exported. XLSX is written with the standard library (a zip of
+# SpreadsheetML parts streamed through zipfile), no extra dependency needed.
+
+import csv
+import re
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.db.models import Count, Sum
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+ORDER_EXPORT_HEADER = ['Order ID', 'Date', 'Customer', 'Influencer', 'Status', 'Items', 'Total Amount']
+
+
+# ---------- data ----------
+
+def order_export_rows(orders, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield one list per order; items / influencers are prefetched per chunk."""
+    orders = orders.select_related('user').prefetch_related('items__product__influencer').order_by('-created_at', '-id')
+    for order in orders.iterator(chunk_size=chunk_size):
+        items = list(order.items.all())
+        influencers = sorted({
+            item.product.influencer.username
+            for item in items
+            if item.product and item.product.influencer
+        })
+        yield [
+            order.id,
+            timezone.localtime(order.created_at).strftime('%Y-%m-%d %H:%M'),
+            order.user.username,
+            ', '.join(influencers) or 'N/A',
+            order.status,
+            sum(item.quantity for item in items),
+            order.total_amount,
+        ]
+
+
+def orders_summary(orders):
+    """Order count and revenue per status plus totals, from one grouped aggregate query."""
+    by_status = {
+        row['status']: {'count': row['count'], 'revenue': row['revenue'] or Decimal('0.00')}
+        for row in orders.order_by().values('status').annotate(count=Count('id'), revenue=Sum('total_amount'))
+    }
+    return {
+        'by_status': by_status,
+        'total_orders': sum(row['count'] for row in by_status.values()),
+        'total_revenue': sum((row['revenue'] for row in by_status.values()), Decimal('0.00')),
+    }
+
+
+def summary_rows(summary):
+    rows = [[], ['Summary'], ['Status', 'Orders', 'Revenue']]
+    for status, row in summary['by_status'].items():
+        rows.append([status, row['count'], row['revenue']])
+    rows.append(['Total', summary['total_orders'], summary['total_revenue']])
+    return rows
+
+
+def order_export_table(orders):
+    """Header, order rows, then the summary block (its query runs after the rows are sent)."""
+    yield ORDER_EXPORT_HEADER
+    yield from order_export_rows(orders)
+    yield from summary_rows(orders_summary(orders))
+
+
+# ---------- CSV ----------
+
+class _Echo:
+    """File-like object whose write() just returns the line, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+# ---------- XLSX ----------
+
+_XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class StreamBuffer:
+    """Unseekable sink for zipfile; take() hands over what has been written so far."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _xlsx_cell(value):
+    if isinstance(value, bool) or value is None:
+        value = '' if value is None else str(value)
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c><v>{value}</v></c>'
+    text = escape(_XML_ILLEGAL.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def stream_xlsx(rows, sheet_name='Orders'):
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        archive.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(sheet_name)}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        yield buffer.take()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            for row in rows:
+                sheet.write(('<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>').encode())
+                data = buffer.take()
+                if data:
+                    yield data
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.take()
+
+
+# ---------- responses ----------
+
+EXPORT_FORMATS = {
+    'csv': (stream_csv, 'text/csv', 'csv'),
+    'xlsx': (stream_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+
+def streaming_export_response(rows, export_format, filename):
+    """StreamingHttpResponse writing `rows` as CSV or XLSX (unknown formats fall back to CSV)."""
+    stream, content_type, extension = EXPORT_FORMATS.get(export_format, EXPORT_FORMATS['csv'])
+    response = StreamingHttpResponse(stream(rows), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{extension}"'
+    return response
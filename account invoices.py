@@ -0,0 +1,304 @@
+# accounts/invoices.py
+#
+# PDF invoices, rendered once per order version and kept under
+# MEDIA_ROOT/invoices/<order id>/. The outbox relay renders them in the
+# background when an order completes (see accounts/outbox.py); downloads only
+# read the stored file, handing it to the web server when a sendfile header is
+# configured:
+#     SENDFILE_HEADER = 'X-Accel-Redirect'   # nginx, with SENDFILE_URL_PREFIX = '/protected/'
+#     SENDFILE_HEADER = 'X-Sendfile'         # Apache mod_xsendfile
+# stream_invoice_archive() zips the invoices of many orders (month-end
+# accounting) as it goes, rendering whatever is missing in the process pool.
+# The PDF is written with the standard library (text + lines, built-in
+# Helvetica), no extra dependency needed.
+
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.utils import timezone
+
+from .exports import StreamBuffer
+from .models import Invoice, Order
+
+
+INVOICE_RENDER_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+INVOICE_ARCHIVE_CHUNK = INVOICE_RENDER_WORKERS * 2  # PDFs held in memory while zipping
+COPY_BUFFER_SIZE = 64 * 1024
+
+COMPANY = {
+    'name': 'LumosKart',
+    'address': '123 Business Street, City, State 12345',
+    'email': 'contact@lumoskart.com',
+    'phone': '(123) 456-7890',
+}
+
+_pool = None
+
+
+def invoice_pool():
+    """Process pool for rendering; created on first use in the relay process."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=INVOICE_RENDER_WORKERS)
+    return _pool
+
+
+def invoice_version(order):
+    return timezone.localtime(order.updated_at).strftime('%Y%m%d%H%M%S%f')
+
+
+def invoice_filename(order_id, version):
+    return f'{order_id}/invoice-{order_id}-{version}.pdf'
+
+
+# ---------- data ----------
+
+def invoice_orders(order_ids):
+    return (
+        Order.objects.filter(id__in=order_ids)
+        .select_related('user')
+        .prefetch_related('items__product')
+    )
+
+
+def invoice_data(order):
+    """Everything the PDF shows, as plain strings (picklable for the render pool)."""
+    items = list(order.items.all())
+    return {
+        'company': COMPANY,
+        'order_id': order.id,
+        'date': timezone.localtime(order.created_at).strftime('%d %b %Y'),
+        'status': order.status,
+        'customer': order.user.get_full_name() or order.user.username,
+        'email': order.user.email or '',
+        'address': order.address or '',
+        'items': [
+            [
+                item.product.name if item.product else 'Removed product',
+                str(item.quantity),
+                f'{item.price:.2f}',
+                f'{item.price * item.quantity:.2f}',
+            ]
+            for item in items
+        ],
+        'subtotal': f"{sum((item.price * item.quantity for item in items), Decimal('0.00')):.2f}",
+        'total': f'{order.total_amount:.2f}',
+    }
+
+
+# ---------- PDF ----------
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in points
+MARGIN = 50
+ROW_HEIGHT = 16
+COLUMNS = [MARGIN, 340, 410, 490]  # product, qty, price, amount
+
+
+def _pdf_string(text):
+    text = str(text).replace('₹', 'Rs.').encode('latin-1', 'replace').decode('latin-1')
+    return '(' + text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+
+def _pdf_lines(data):
+    """Yield page-sized lists of drawing operators."""
+    ops = []
+    y = PAGE_HEIGHT - MARGIN
+
+    def text(x, y, value, size=10, bold=False):
+        ops.append(f'BT /{"F2" if bold else "F1"} {size} Tf {x} {y} Td {_pdf_string(value)} Tj ET')
+
+    def rule(y):
+        ops.append(f'{MARGIN} {y} m {PAGE_WIDTH - MARGIN} {y} l S')
+
+    def table_header(y):
+        for x, title in zip(COLUMNS, ['Product', 'Qty', 'Price', 'Amount']):
+            text(x, y, title, bold=True)
+        rule(y - 5)
+        return y - ROW_HEIGHT - 4
+
+    company = data['company']
+    text(MARGIN, y, company['name'], size=20, bold=True)
+    text(380, y, f"INVOICE #{data['order_id']}", size=14, bold=True)
+    y -= 18
+    text(MARGIN, y, company['address'])
+    text(380, y, f"Date: {data['date']}")
+    y -= 14
+    text(MARGIN, y, f"{company['email']}  |  {company['phone']}")
+    text(380, y, f"Status: {data['status']}")
+    y -= 30
+    text(MARGIN, y, 'Bill to', bold=True)
+    y -= 14
+    for line in [data['customer'], data['email']] + data['address'].splitlines():
+        if line.strip():
+            text(MARGIN, y, line.strip())
+            y -= 14
+    y = table_header(y - 16)
+
+    for row in data['items']:
+        if y < MARGIN + 3 * ROW_HEIGHT:
+            yield ops
+            ops = []
+            y = table_header(PAGE_HEIGHT - MARGIN)
+        text(COLUMNS[0], y, row[0][:55])
+        for x, value in zip(COLUMNS[1:], row[1:]):
+            text(x, y, value)
+        y -= ROW_HEIGHT
+
+    rule(y + ROW_HEIGHT - 5)
+    if y < MARGIN + 2 * ROW_HEIGHT:
+        yield ops
+        ops = []
+        y = PAGE_HEIGHT - MARGIN
+    text(COLUMNS[2], y - 4, 'Subtotal')
+    text(COLUMNS[3], y - 4, f"Rs. {data['subtotal']}")
+    text(COLUMNS[2], y - 4 - ROW_HEIGHT, 'Total', bold=True)
+    text(COLUMNS[3], y - 4 - ROW_HEIGHT, f"Rs. {data['total']}", bold=True)
+    yield ops
+
+
+def render_invoice_pdf(data):
+    """Render invoice_data() as PDF bytes. Pure function, runs in the render pool."""
+    pages = [('\n'.join(ops)).encode('latin-1') for ops in _pdf_lines(data)]
+    first_page = 5
+    page_ids = [first_page + 2 * index for index in range(len(pages))]
+
+    objects = {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {len(pages)} >>".encode(),
+        3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+        4: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+    }
+    for page_id, content in zip(page_ids, pages):
+        objects[page_id] = (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+            f'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {page_id + 1} 0 R >>'
+        ).encode()
+        objects[page_id + 1] = b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream'
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(output)
+        output += b'%d 0 obj\n' % number + objects[number] + b'\nendobj\n'
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for number in sorted(objects):
+        output += b'%010d 00000 n \n' % offsets[number]
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(output)
+
+
+# ---------- storing ----------
+
+def store_invoice(order, version, pdf):
+    """Save the PDF as the order's invoice for `version` and drop older versions."""
+    try:
+        with transaction.atomic():
+            invoice = Invoice(order=order, version=version)
+            invoice.file.save(invoice_filename(order.id, version), ContentFile(pdf), save=False)
+            invoice.save()
+    except IntegrityError:
+        # rendered concurrently by someone else; keep theirs
+        invoice.file.delete(save=False)
+        return Invoice.objects.get(order=order, version=version)
+
+    for old in Invoice.objects.filter(order=order).exclude(version=version):
+        old.delete()
+        # the file goes only once the row is really gone; if the caller's
+        # transaction rolls back, the old invoice still points at it
+        transaction.on_commit(lambda name=old.file.name, storage=old.file.storage: storage.delete(name), robust=True)
+    return invoice
+
+
+def current_invoices(order_ids, pool=None):
+    """
+    Yield the current invoice of each order in `order_ids` (in that order),
+    rendering the missing ones chunk by chunk (in the pool if given) and
+    storing them for next time.
+    """
+    order_ids = list(order_ids)
+    chunk_size = INVOICE_ARCHIVE_CHUNK if pool else 1
+    for start in range(0, len(order_ids), chunk_size):
+        chunk = order_ids[start:start + chunk_size]
+        versions = {
+            order.id: invoice_version(order)
+            for order in Order.objects.filter(id__in=chunk).only('id', 'updated_at')
+        }
+        stored = {
+            invoice.order_id: invoice
+            for invoice in Invoice.objects.filter(order_id__in=chunk)
+            if invoice.version == versions[invoice.order_id]
+        }
+        missing = list(invoice_orders([order_id for order_id in versions if order_id not in stored]))
+        if missing:
+            data = [invoice_data(order) for order in missing]
+            pdfs = pool.map(render_invoice_pdf, data) if pool else map(render_invoice_pdf, data)
+            for order, pdf in zip(missing, pdfs):
+                stored[order.id] = store_invoice(order, invoice_version(order), pdf)
+        for order_id in chunk:
+            if order_id in stored:
+                yield stored[order_id]
+
+
+def build_invoices(order_ids):
+    """Render (in the process pool) and store the invoices the orders do not have yet."""
+    for _ in current_invoices(order_ids, pool=invoice_pool()):
+        pass
+
+
+def get_invoice(order):
+    """The stored invoice for the order's current version, rendered inline if missing."""
+    return next(current_invoices([order.id]))
+
+
+def stream_invoice_archive(orders, folder='invoices'):
+    """
+    Yield a zip of the current invoice of every order, written file by file
+    through an unseekable buffer: at most one render chunk of PDFs is held in
+    memory and stored files are copied COPY_BUFFER_SIZE bytes at a time.
+    """
+    order_ids = list(orders.order_by('created_at', 'id').values_list('id', flat=True))
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for invoice in current_invoices(order_ids, pool=invoice_pool()):
+            name = f'{folder}/invoice-{invoice.order_id}.pdf'
+            with invoice.file.open('rb') as source, archive.open(name, 'w', force_zip64=True) as target:
+                for data in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+                    target.write(data)
+                    compressed = buffer.take()
+                    if compressed:
+                        yield compressed
+    yield buffer.take()
+
+
+# ---------- serving ----------
+
+def invoice_response(request, invoice):
+    """
+    Serve the stored PDF; with SENDFILE_HEADER set the web server sends the
+    bytes and Django only returns headers. The version doubles as the ETag.
+    """
+    etag = f'"{invoice.order_id}-{invoice.version}"'
+    if request.headers.get('If-None-Match') == etag:
+        return HttpResponseNotModified()
+
+    filename = f'invoice-{invoice.order_id}.pdf'
+    header = getattr(settings, 'SENDFILE_HEADER', None)
+    if header == 'X-Accel-Redirect':
+        response = HttpResponse(content_type='application/pdf')
+        response[header] = getattr(settings, 'SENDFILE_URL_PREFIX', '/protected/') + invoice.file.name
+    elif header:
+        response = HttpResponse(content_type='application/pdf')
+        response[header] = invoice.file.path
+    else:
+        response = FileResponse(invoice.file.open('rb'), content_type='application/pdf')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=3600'
+    return response
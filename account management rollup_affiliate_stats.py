@@ -0,0 +1,29 @@
+# accounts/management/commands/rollup_affiliate_stats.py
+#
+#     python manage.py rollup_affiliate_stats               # the last three hours
+#     python manage.py rollup_affiliate_stats --hours 720   # backfill the last 30 days
+#
+# The affiliate dashboards only read AffiliateRollup, so run it every hour,
+# e.g. from cron a few minutes past the hour:
+#     5 * * * *  cd /srv/lumoskart && python manage.py rollup_affiliate_stats
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from accounts.affiliate import rollup_affiliate_stats
+
+
+class Command(BaseCommand):
+    help = 'Fold affiliate clicks and orders into the hourly AffiliateRollup rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=3, help='How many hours back to recompute (current hour included).')
+
+    def handle(self, *args, **options):
+        if options['hours'] < 1:
+            raise CommandError('--hours must be at least 1')
+        now = timezone.now()
+        rows = rollup_affiliate_stats(start=now - timedelta(hours=options['hours'] - 1), end=now)
+        self.stdout.write(f"Wrote {rows} affiliate rollup rows")
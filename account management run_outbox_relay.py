@@ -0,0 +1,22 @@
+# accounts/management/commands/run_outbox_relay.py
+#
+#     python manage.py run_outbox_relay            # keep relaying (one process is enough)
+#     python manage.py run_outbox_relay --once     # single pass, e.g. from cron
+
+from django.core.management.base import BaseCommand
+
+from accounts.outbox import relay_once, run_outbox_relay
+
+
+class Command(BaseCommand):
+    help = 'Hand new order events to the outbox consumers (earnings, emails, invoices).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls when idle.')
+        parser.add_argument('--once', action='store_true', help='Relay one batch per consumer and exit.')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            self.stdout.write(f"Relayed {relay_once()} events")
+            return
+        run_outbox_relay(poll_interval=options['interval'])
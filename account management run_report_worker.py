@@ -0,0 +1,22 @@
+# accounts/management/commands/run_report_worker.py
+#
+#     python manage.py run_report_worker            # keep building queued reports (run one or more)
+#     python manage.py run_report_worker --once     # build what is queued now and exit, e.g. from cron
+
+from django.core.management.base import BaseCommand
+
+from accounts.reports import process_report_jobs, run_report_worker
+
+
+class Command(BaseCommand):
+    help = 'Build queued admin report exports (ReportJob) into downloadable files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls when idle.')
+        parser.add_argument('--once', action='store_true', help='Run the queued jobs and exit.')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            self.stdout.write(f"Ran {process_report_jobs()} report jobs")
+            return
+        run_report_worker(poll_interval=options['interval'])
@@ -0,0 +1,252 @@
+# accounts/order_search.py
+#
+# Search index for the admin order list. Each order's searchable text
+# (customer username / name / email / phone, delivery address, product names)
+# is split into terms stored in OrderSearchTerm, one row per (order, term)
+# with a weight. A query term matches by prefix (term LIKE 'abc%'), which the
+# index on OrderSearchTerm.term serves on every database; orders must match
+# every query term and are ranked by the summed weights.
+#
+# Rows are refreshed after the transaction that wrote the order or its items
+# commits (Order.save / OrderItem.save / delete schedule it). To (re)build
+# the whole index:
+#     from accounts.order_search import rebuild_order_search_index; rebuild_order_search_index()
+#
+# filter_admin_orders() applies the whole manage_orders filter set (search box
+# included, every match, unranked); the exports and the background reports
+# use it. The list view filters without the search box and ranks the matches
+# inside the filtered orders a page at a time (search_orders(within=...)).
+
+import re
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Case, Exists, IntegerField, Max, OuterRef, Q, Sum, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Order, OrderItem, OrderSearchTerm
+
+
+SEARCH_RESULTS_LIMIT = 200
+TERM_MAX_LENGTH = 64
+INDEX_BATCH_SIZE = 500
+
+# weight of a matching term, by where it came from
+WEIGHTS = {
+    'email': 8,
+    'phone': 8,
+    'username': 6,
+    'name': 4,
+    'product': 3,
+    'address': 2,
+}
+
+_WORD = re.compile(r'[^\W_]+')
+_PHONE_QUERY = re.compile(r'^[\d\s+()-]{6,}$')
+
+
+def _words(text):
+    return [word for word in _WORD.findall((text or '').lower()) if len(word) >= 2]
+
+
+def phone_terms(phone):
+    """Digits only, plus the last ten digits so numbers match with or without the country code."""
+    digits = re.sub(r'\D', '', phone or '')
+    return {digits, digits[-10:]} - {''}
+
+
+def order_terms(order):
+    """{term: weight} for one order (user and items must be loaded)."""
+    terms = {}
+
+    def add(term, weight):
+        term = term[:TERM_MAX_LENGTH]
+        terms[term] = max(terms.get(term, 0), weight)
+
+    user = order.user
+    if user.email:
+        add(user.email.lower(), WEIGHTS['email'])
+        for word in _words(user.email):
+            add(word, WEIGHTS['name'])
+    for term in phone_terms(getattr(user, 'phone', None)):
+        add(term, WEIGHTS['phone'])
+    add(user.username.lower(), WEIGHTS['username'])
+    for word in _words(user.get_full_name()) + _words(getattr(user, 'full_name', None)):
+        add(word, WEIGHTS['name'])
+    for word in _words(order.address):
+        add(word, WEIGHTS['address'])
+    for item in order.items.all():
+        if item.product:
+            for word in _words(item.product.name):
+                add(word, WEIGHTS['product'])
+    return terms
+
+
+def index_orders(order_ids):
+    """Replace the search terms of the given orders (deleted orders just lose theirs)."""
+    order_ids = list(order_ids)
+    orders = Order.objects.filter(id__in=order_ids).select_related('user').prefetch_related('items__product')
+    with transaction.atomic():
+        OrderSearchTerm.objects.filter(order_id__in=order_ids).delete()
+        OrderSearchTerm.objects.bulk_create([
+            OrderSearchTerm(order_id=order.id, term=term, weight=weight)
+            for order in orders
+            for term, weight in order_terms(order).items()
+        ], batch_size=INDEX_BATCH_SIZE)
+
+
+def rebuild_order_search_index(batch_size=INDEX_BATCH_SIZE):
+    """Index every order, batch_size orders per transaction; returns how many were indexed."""
+    last_id = 0
+    indexed = 0
+    while True:
+        ids = list(
+            Order.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return indexed
+        index_orders(ids)
+        indexed += len(ids)
+        last_id = ids[-1]
+
+
+def query_terms(query):
+    """Terms to look up for a search box query."""
+    query = query.strip().lower()
+    if _PHONE_QUERY.match(query):
+        return [re.sub(r'\D', '', query)[:TERM_MAX_LENGTH]]
+    terms = []
+    for chunk in query.split():
+        if '@' in chunk:
+            terms.append(chunk[:TERM_MAX_LENGTH])
+        else:
+            terms += [word[:TERM_MAX_LENGTH] for word in _words(chunk)]
+    return list(dict.fromkeys(terms))
+
+
+def _exact_order_id(query):
+    """'#123' / '123' -> 123, else None."""
+    exact_id = query.strip().lstrip('#')
+    return int(exact_id) if exact_id.isdigit() else None
+
+
+def matching_terms(terms):
+    """
+    OrderSearchTerm grouped per order, for the orders that match every term,
+    with their `score`; unordered.
+    """
+    matches = Q()
+    for term in terms:
+        matches |= Q(term__startswith=term)
+    hits = {
+        f'hit_{index}': Max(Case(When(term__startswith=term, then=Value(1)), default=Value(0), output_field=IntegerField()))
+        for index, term in enumerate(terms)
+    }
+    return (
+        OrderSearchTerm.objects.filter(matches)
+        .values('order_id')
+        .annotate(
+            score=Sum('weight') + Sum(Case(
+                When(term__in=terms, then='weight'),  # whole-term matches count double
+                default=Value(0),
+                output_field=IntegerField()
+            )),
+            **hits
+        )
+        .filter(**{name: 1 for name in hits})
+    )
+
+
+def search_orders(query, limit=SEARCH_RESULTS_LIMIT, offset=0, within=None):
+    """
+    Ids of the orders matching `query`, best first, from `offset` on.
+    '#123' / '123' also finds order 123 itself, ranked above everything else.
+    `within` (an Order queryset) restricts the ranking to those orders, so
+    filters are applied before the page is cut rather than after.
+    """
+    query = (query or '').strip()
+    orders = within if within is not None else Order.objects.all()
+    exact_id = _exact_order_id(query)
+    direct = [exact_id] if exact_id is not None and orders.filter(id=exact_id).exists() else []
+    head = direct[offset:limit + offset if limit is not None else None]
+
+    terms = query_terms(query)
+    if not terms or (limit is not None and len(head) >= limit):
+        return head
+
+    ranked = matching_terms(terms).exclude(order_id__in=direct)
+    if within is not None:
+        ranked = ranked.filter(order_id__in=within.values('id'))
+    ranked = ranked.order_by('-score', '-order_id').values_list('order_id', flat=True)
+    start = max(0, offset - len(direct))
+    if limit is None:
+        return head + list(ranked[start:])
+    return head + list(ranked[start:start + limit - len(head)])
+
+
+def search_filter(query):
+    """Q for the orders matching `query` (no ranking, no limit), to filter a queryset with."""
+    query = (query or '').strip()
+    exact_id = _exact_order_id(query)
+    found = Q(id=exact_id) if exact_id is not None else Q(pk__in=[])
+    terms = query_terms(query)
+    if terms:
+        found |= Q(id__in=matching_terms(terms).values_list('order_id', flat=True))
+    return found
+
+
+# ---------- admin order list ----------
+
+def parse_filter_date(value):
+    """The date in a YYYY-MM-DD filter value; None if it is empty or no real date."""
+    try:
+        return parse_date(value or '')
+    except ValueError:
+        # well formed but impossible, e.g. 2026-02-30
+        return None
+
+
+def invalid_filter_date(params, *keys):
+    """The first params[key] that is given but is not a valid date, else None."""
+    for key in keys:
+        value = params.get(key)
+        if value and parse_filter_date(value) is None:
+            return value
+    return None
+
+
+def filter_admin_orders(orders, params):
+    """
+    Apply the manage_orders filters (search, influencer, customer, status, date).
+    The search box goes through the order search index; the influencer
+    filter is an EXISTS subquery on the order's items, so no join fan-out and
+    no DISTINCT; the date filter is a range on created_at so the
+    (status, created_at) index can be used.
+    """
+    search = (params.get('q') or '').strip()
+    influencer_filter = params.get('influencer')
+    customer_filter = params.get('customer')
+    status_filter = params.get('status')
+    date_filter = params.get('date')
+
+    if search:
+        orders = orders.filter(search_filter(search))
+
+    if influencer_filter:
+        orders = orders.filter(Exists(
+            OrderItem.objects.filter(
+                order=OuterRef('pk'),
+                product__influencer__username__icontains=influencer_filter
+            )
+        ))
+    if customer_filter:
+        orders = orders.filter(user__username__icontains=customer_filter)
+    if status_filter:
+        orders = orders.filter(status=status_filter)
+    if date_filter:
+        parsed_date = parse_filter_date(date_filter)
+        if parsed_date:
+            day_start = timezone.make_aware(datetime.combine(parsed_date, datetime.min.time()))
+            orders = orders.filter(created_at__gte=day_start, created_at__lt=day_start + timedelta(days=1))
+    return orders
@@ -0,0 +1,109 @@
+# accounts/order_status.py
+#
+# Every order status change goes through here so the history row and the
+# OrderEvent for the outbox (accounts/outbox.py) are written in the same
+# transaction as the change.
+#
+# Bulk transitions for staff: orders are grouped by their current status and
+# each group is moved with one conditional
+#     UPDATE ... WHERE id IN (...) AND status = <old>
+# so an order someone else changed in the meantime is skipped rather than
+# overwritten. History and event rows are written with bulk_create.
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order, OrderEvent, OrderStatusHistory
+
+
+def status_event(order_id, old_status, new_status, changed_by=None):
+    return OrderEvent(
+        order_id=order_id,
+        event_type=OrderEvent.STATUS_CHANGED,
+        payload={
+            'old_status': old_status,
+            'new_status': new_status,
+            'changed_by': changed_by.id if changed_by is not None else None,
+        }
+    )
+
+
+def change_order_status(order, new_status, changed_by=None):
+    """
+    Set order.status, save it and log the change (history + outbox event)
+    atomically. Returns False if the order already had that status.
+    Order.save() writes only the dirty columns, so this is a single UPDATE.
+    """
+    old_status = order.loaded_value('status')
+    if old_status == new_status:
+        return False
+
+    with transaction.atomic():
+        order.status = new_status
+        order.save()
+        OrderStatusHistory.objects.create(
+            order=order,
+            old_status=old_status,
+            new_status=new_status,
+            changed_by=changed_by
+        )
+        status_event(order.id, old_status, new_status, changed_by).save()
+    return True
+
+
+def bulk_transition(order_ids, new_status, changed_by=None):
+    """
+    Move the given orders to new_status where Order.ALLOWED_TRANSITIONS permits.
+    Returns (updated_ids, skipped) where skipped is {order_id: reason}.
+    """
+    if new_status not in dict(Order.ORDER_STATUS_CHOICES):
+        raise ValueError(f'Invalid status: {new_status}')
+
+    order_ids = {int(order_id) for order_id in order_ids}
+    current = dict(Order.objects.filter(id__in=order_ids).values_list('id', 'status'))
+
+    skipped = {}
+    by_old_status = {}
+    for order_id in sorted(order_ids):
+        old_status = current.get(order_id)
+        if old_status is None:
+            skipped[order_id] = 'not found'
+        elif old_status == new_status:
+            skipped[order_id] = f'already {new_status}'
+        elif new_status not in Order.ALLOWED_TRANSITIONS.get(old_status, set()):
+            skipped[order_id] = f'{old_status} → {new_status} not allowed'
+        else:
+            by_old_status.setdefault(old_status, []).append(order_id)
+
+    updated = []
+    history = []
+    events = []
+    now = timezone.now()
+    with transaction.atomic():
+        for old_status, ids in by_old_status.items():
+            # lock the rows still in old_status so we know exactly which ones the UPDATE hits
+            locked = list(
+                Order.objects.select_for_update()
+                .filter(id__in=ids, status=old_status)
+                .order_by('id')
+                .values_list('id', flat=True)
+            )
+            Order.objects.filter(id__in=locked, status=old_status).update(status=new_status, updated_at=now)
+
+            for order_id in set(ids) - set(locked):
+                skipped[order_id] = 'status changed meanwhile'
+            updated += locked
+            history += [
+                OrderStatusHistory(
+                    order_id=order_id,
+                    old_status=old_status,
+                    new_status=new_status,
+                    changed_by=changed_by
+                )
+                for order_id in locked
+            ]
+            events += [status_event(order_id, old_status, new_status, changed_by) for order_id in locked]
+        OrderStatusHistory.objects.bulk_create(history)
+        OrderEvent.objects.bulk_create(events)
+
+    return sorted(updated), skipped
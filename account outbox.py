@@ -0,0 +1,227 @@
+# accounts/outbox.py
+#
+# Outbox relay: hands OrderEvent rows to in-process consumers (earnings,
+# notifications, ...) outside the request path. Each consumer keeps its own
+# checkpoint (OutboxCheckpoint.last_event_id) and is fed batches in id order.
+# The consumer's database writes and its checkpoint commit in one transaction,
+# so a batch is applied exactly once; a failing batch is retried on the next
+# tick without holding back the other consumers. Side effects outside the
+# database (emails) are sent once that transaction has committed.
+#
+# Event ids are handed out before commit, so a slow transaction can commit a
+# lower id after the checkpoint has moved past it. Every id the checkpoint
+# skips is remembered in OutboxCheckpoint.pending and delivered when its event
+# shows up; ids still missing after OUTBOX_GAP_TIMEOUT belong to rolled-back
+# transactions and are dropped.
+#
+# Run the relay in its own process:
+#     python manage.py run_outbox_relay
+
+import logging
+import threading
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.mail import send_mass_mail
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .invoices import build_invoices
+from .models import Order, OrderEvent, OrderItem, OutboxCheckpoint
+
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 500
+# longer than any transaction that writes an OrderEvent can stay open
+OUTBOX_GAP_TIMEOUT = timedelta(minutes=10)
+
+CONSUMERS = {}
+
+
+def outbox_consumer(name):
+    """
+    Register fn(events) as a consumer; it gets lists of OrderEvent in id order.
+    An event that committed late arrives in a later batch than higher ids;
+    status changes of one order still arrive in order (they lock the order row).
+    """
+    def register(fn):
+        CONSUMERS[name] = fn
+        return fn
+    return register
+
+
+def relay_consumer(name, batch_size=OUTBOX_BATCH_SIZE):
+    """Feed one batch to one consumer; returns the number of events it processed."""
+    handler = CONSUMERS[name]
+    OutboxCheckpoint.objects.get_or_create(consumer=name)
+
+    with transaction.atomic():
+        checkpoint = (
+            OutboxCheckpoint.objects.select_for_update(skip_locked=True)
+            .filter(consumer=name)
+            .first()
+        )
+        if checkpoint is None:
+            return 0  # another relay process has this consumer right now
+
+        pending = {int(event_id): seen for event_id, seen in checkpoint.pending.items()}
+        events = list(
+            OrderEvent.objects
+            .filter(Q(id__gt=checkpoint.last_event_id) | Q(id__in=list(pending)))
+            .order_by('id')[:batch_size]
+        )
+
+        now = timezone.now()
+        for event in events:
+            pending.pop(event.id, None)
+        new_ids = [event.id for event in events if event.id > checkpoint.last_event_id]
+        if new_ids:
+            skipped = set(range(checkpoint.last_event_id + 1, new_ids[-1])) - set(new_ids)
+            pending.update({event_id: now.isoformat() for event_id in skipped})
+            checkpoint.last_event_id = new_ids[-1]
+        expired = [
+            event_id for event_id, seen in pending.items()
+            if parse_datetime(seen) < now - OUTBOX_GAP_TIMEOUT
+        ]
+        for event_id in expired:
+            del pending[event_id]
+        if not events and not expired:
+            return 0
+
+        if events:
+            handler(events)
+        checkpoint.pending = {str(event_id): seen for event_id, seen in sorted(pending.items())}
+        checkpoint.save(update_fields=['last_event_id', 'pending', 'updated_at'])
+    return len(events)
+
+
+def relay_once(batch_size=OUTBOX_BATCH_SIZE):
+    """One batch for every consumer; returns the total number of events processed."""
+    processed = 0
+    for name in CONSUMERS:
+        try:
+            processed += relay_consumer(name, batch_size)
+        except Exception:
+            logger.exception('Outbox consumer %s failed; the batch will be retried', name)
+    return processed
+
+
+def run_outbox_relay(poll_interval=1.0, stop_event=None):
+    """Relay events until stop_event is set (or Ctrl-C)."""
+    stop_event = stop_event or threading.Event()
+    try:
+        while not stop_event.is_set():
+            close_old_connections()
+            if not relay_once():
+                stop_event.wait(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_old_connections()
+
+
+# ---------- consumers ----------
+
+def _status_changes(events):
+    return [event for event in events if event.event_type == OrderEvent.STATUS_CHANGED]
+
+
+@outbox_consumer('influencer_earnings')
+def credit_influencer_earnings(events):
+    """
+    Credit each influencer's share of an order to their WeeklyEarning the
+    first time it is paid: completed online, or delivered (cash on delivery,
+    Pending -> Shipped -> Delivered). Take it back if the order is canceled
+    after that. Anything else (shipping, delivering a completed order)
+    changes nothing.
+    """
+    from .models import WeeklyEarning
+
+    paid_on = (Order.COMPLETED, Order.DELIVERED)
+    status_changes = _status_changes(events)
+    order_ids = {event.order_id for event in status_changes}
+    # events that paid these orders, earlier ones included
+    paid_by = {}
+    for order_id, event_id in OrderEvent.objects.filter(
+        order_id__in=list(order_ids),
+        event_type=OrderEvent.STATUS_CHANGED,
+        payload__new_status__in=paid_on
+    ).values_list('order_id', 'id'):
+        paid_by.setdefault(order_id, []).append(event_id)
+
+    def paid_before(event):
+        return any(event_id < event.id for event_id in paid_by.get(event.order_id, []))
+
+    changes = {}
+    for event in status_changes:
+        new_status = event.payload.get('new_status')
+        if new_status in paid_on and not paid_before(event):
+            changes.setdefault(event.order_id, []).append((1, event.created_at))
+        elif new_status == Order.CANCELED and paid_before(event):
+            changes.setdefault(event.order_id, []).append((-1, event.created_at))
+    if not changes:
+        return
+
+    per_week = {}
+    items = OrderItem.objects.filter(
+        order_id__in=list(changes),
+        product__influencer__isnull=False
+    ).select_related('order', 'product')
+    for item in items:
+        share = item.price * item.quantity * (1 - item.order.commission_percentage / Decimal('100'))
+        for sign, when in changes[item.order_id]:
+            day = timezone.localtime(when).date()
+            week_start = day - timedelta(days=day.weekday())
+            key = (item.product.influencer_id, week_start)
+            per_week[key] = per_week.get(key, Decimal('0.00')) + sign * share
+
+    for (influencer_id, week_start), amount in per_week.items():
+        earning, _ = WeeklyEarning.objects.get_or_create(
+            influencer_id=influencer_id,
+            week_start_date=week_start,
+            withdrawn=False,
+            defaults={'earnings': 0}
+        )
+        WeeklyEarning.objects.filter(id=earning.id).update(earnings=F('earnings') + amount)
+
+
+@outbox_consumer('order_notifications')
+def notify_customers(events):
+    """Email the customer when their order is completed, shipped, delivered or canceled."""
+    notify = {Order.COMPLETED, Order.SHIPPED, Order.DELIVERED, Order.CANCELED}
+    changes = {
+        event.order_id: event.payload['new_status']
+        for event in _status_changes(events)
+        if event.payload.get('new_status') in notify
+    }
+    orders = Order.objects.filter(id__in=list(changes)).select_related('user')
+    messages = [
+        (
+            f'Your LumosKart order #{order.id} is {changes[order.id].lower()}',
+            f'Hi {order.user.username},\n\nYour order #{order.id} is now {changes[order.id]}.\n\nThank you for shopping with LumosKart.',
+            getattr(settings, 'DEFAULT_FROM_EMAIL', None),
+            [order.user.email],
+        )
+        for order in orders
+        if order.user.email
+    ]
+    if messages:
+        # only once the checkpoint has committed, so a retried batch can't email twice
+        transaction.on_commit(lambda: send_mass_mail(messages, fail_silently=True), robust=True)
+
+
+@outbox_consumer('invoices')
+def render_invoices(events):
+    """Render the PDF invoice of orders that got paid (or changed after being paid)."""
+    order_ids = {
+        event.order_id
+        for event in _status_changes(events)
+        if event.payload.get('old_status') in Order.PAID_STATUSES
+        or event.payload.get('new_status') in Order.PAID_STATUSES
+    }
+    if order_ids:
+        build_invoices(sorted(order_ids))
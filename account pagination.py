@@ -0,0 +1,65 @@
+# accounts/pagination.py
+#
+# Keyset (cursor) pagination on (created_at, id), newest first. Unlike OFFSET
+# pages, fetching page 1000 costs the same as page 1: the cursor turns into a
+# WHERE on the composite index instead of skipping rows.
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(obj):
+    return f'{obj.created_at.isoformat()}_{obj.pk}'
+
+
+def decode_cursor(cursor):
+    """(created_at, id) from a cursor string, or None if it's missing / malformed."""
+    if not cursor:
+        return None
+    created_at, _, pk = cursor.rpartition('_')
+    created_at = parse_datetime(created_at)
+    if created_at is None or not pk.isdigit():
+        return None
+    return created_at, int(pk)
+
+
+class KeysetPage:
+    def __init__(self, items, has_next, has_previous):
+        self.object_list = items
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = encode_cursor(items[-1]) if items and has_next else None
+        self.previous_cursor = encode_cursor(items[0]) if items and has_previous else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def keyset_page(queryset, after=None, before=None, page_size=50):
+    """
+    One page of `queryset` ordered by (-created_at, -id).
+    after / before are cursors from a previous page's next_cursor / previous_cursor.
+    Runs a single query of page_size + 1 rows.
+    """
+    after = decode_cursor(after)
+    before = decode_cursor(before) if after is None else None
+
+    if before is not None:
+        created_at, pk = before
+        rows = list(
+            queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk))
+            .order_by('created_at', 'id')[:page_size + 1]
+        )
+        has_previous = len(rows) > page_size
+        items = rows[:page_size][::-1]
+        return KeysetPage(items, has_next=True, has_previous=has_previous)
+
+    if after is not None:
+        created_at, pk = after
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+    rows = list(queryset.order_by('-created_at', '-id')[:page_size + 1])
+    return KeysetPage(rows[:page_size], has_next=len(rows) > page_size, has_previous=after is not None)
@@ -0,0 +1,301 @@
+# accounts/reports.py
+#
+# Background report jobs for the admin exports. The view only inserts a
+# ReportJob row (identical requests share the queued / running job, or a
+# finished one younger than REPORT_REUSE_WINDOW). A worker claims jobs with
+# SKIP LOCKED, writes the file under MEDIA_ROOT/reports/ and updates the
+# progress (and its heartbeat) as it goes; a job whose worker stops beating is
+# picked up by another. The admin downloads the file once the job is done.
+#
+# Run the worker in its own process (several can share the queue):
+#     python manage.py run_report_worker
+
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.files import File
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, DecimalField, F, Sum
+from django.utils import timezone
+
+from .exports import (
+    ORDER_EXPORT_HEADER, EXPORT_FORMATS, order_export_rows, orders_summary, summary_rows
+)
+from .models import CustomUser, Order, OrderItem, ReportJob
+from .order_search import filter_admin_orders
+
+
+logger = logging.getLogger(__name__)
+
+REPORT_REUSE_WINDOW = timedelta(minutes=10)  # a finished identical report is served again
+REPORT_HEARTBEAT_TIMEOUT = timedelta(minutes=5)  # a running job silent this long is assumed orphaned
+HEARTBEAT_INTERVAL = 30  # seconds; progress is written at least this often while rows flow
+PROGRESS_EVERY = 1000  # rows between progress updates
+REQUEST_ATTEMPTS = 3
+
+# query string keys a report request keeps (the manage_orders filters, search box included)
+REPORT_FILTERS = ('q', 'influencer', 'customer', 'status', 'date')
+
+
+class ReportJobLost(Exception):
+    """Another worker reclaimed the job (this one stopped beating); stop working on it."""
+
+
+# ---------- requesting ----------
+
+def report_params(query):
+    """The report filters set in `query` (request.GET or a dict), for request_report()."""
+    return {key: query.get(key) for key in REPORT_FILTERS if query.get(key)}
+
+
+def report_dedup_key(kind, params, export_format):
+    payload = json.dumps([kind, params, export_format], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def request_report(user, kind, params, export_format='csv'):
+    """
+    Queue a report, or return the identical one already queued / running /
+    recently finished. Returns (job, created).
+    """
+    if kind not in REPORT_BUILDERS:
+        raise ValueError(f'Unknown report: {kind}')
+    if export_format not in EXPORT_FORMATS:
+        export_format = 'csv'
+    params = {key: value for key, value in params.items() if value}
+    dedup_key = report_dedup_key(kind, params, export_format)
+
+    for attempt in range(REQUEST_ATTEMPTS):
+        existing = reusable_report_job(dedup_key)
+        if existing:
+            return existing, False
+        try:
+            with transaction.atomic():
+                job = ReportJob.objects.create(
+                    kind=kind,
+                    params=params,
+                    export_format=export_format,
+                    dedup_key=dedup_key,
+                    requested_by=user
+                )
+            return job, True
+        except IntegrityError:
+            # an identical request won the race (the unique constraint lets only
+            # one through); share its job, or queue again if it already failed
+            if attempt == REQUEST_ATTEMPTS - 1:
+                raise
+
+
+def reusable_report_job(dedup_key):
+    """The identical job queued / running / finished within REPORT_REUSE_WINDOW, if any."""
+    return ReportJob.objects.filter(dedup_key=dedup_key).filter(
+        status__in=[ReportJob.PENDING, ReportJob.RUNNING]
+    ).first() or ReportJob.objects.filter(
+        dedup_key=dedup_key,
+        status=ReportJob.DONE,
+        finished_at__gte=timezone.now() - REPORT_REUSE_WINDOW
+    ).first()
+
+
+# ---------- builders ----------
+# A builder returns (total_rows, rows); total_rows drives the progress percentage.
+
+def build_manage_orders_report(params):
+    orders = filter_admin_orders(Order.objects.all(), params)
+    summary = orders_summary(orders)
+
+    def rows():
+        yield ORDER_EXPORT_HEADER
+        yield from order_export_rows(orders)
+        yield from summary_rows(summary)
+
+    return summary['total_orders'], rows()
+
+
+def build_admin_dashboard_report(params):
+    by_status = {
+        row['status']: row
+        for row in Order.objects.order_by().values('status').annotate(
+            count=Count('id'),
+            revenue=Sum('total_amount'),
+            commission=Sum('commission_amount'),
+            # for orders saved before commission_amount was filled in (same fallback as the dashboard)
+            estimated_commission=Sum(
+                F('total_amount') * F('commission_percentage') / 100,
+                output_field=DecimalField(max_digits=14, decimal_places=2)
+            )
+        )
+    }
+    paid = [by_status[status] for status in Order.PAID_STATUSES if status in by_status]
+
+    def paid_total(key):
+        return sum((row[key] or Decimal('0.00') for row in paid), Decimal('0.00'))
+
+    total_revenue = paid_total('revenue')
+    total_commission = paid_total('commission') or paid_total('estimated_commission')
+
+    users = {
+        (row['user_type'], row['is_active']): row['count']
+        for row in CustomUser.objects.order_by().values('user_type', 'is_active').annotate(count=Count('id'))
+    }
+
+    paid_items = OrderItem.objects.filter(order__status__in=Order.PAID_STATUSES).order_by()
+    top_influencers = (
+        paid_items.filter(product__influencer__isnull=False)
+        .values('product__influencer__username')
+        .annotate(revenue=Sum(F('price') * F('quantity')))
+        .order_by('-revenue')[:5]
+    )
+    top_products = (
+        paid_items.values('product__name')
+        .annotate(sold=Sum('quantity'))
+        .order_by('-sold')[:10]
+    )
+
+    rows = [
+        ['Metric', 'Value'],
+        ['Total revenue', total_revenue],
+        ['Total commission', total_commission],
+        ['Influencer earnings', total_revenue - total_commission],
+        ['Active influencers', users.get(('influencer', True), 0)],
+        ['Active customers', users.get(('customer', True), 0)],
+        ['Pending influencer approvals', users.get(('influencer', False), 0)],
+    ]
+    for status, _ in Order.ORDER_STATUS_CHOICES:
+        rows.append([f'{status} orders', by_status.get(status, {}).get('count', 0)])
+    rows += [[], ['Top influencers', 'Revenue']]
+    rows += [[row['product__influencer__username'], row['revenue']] for row in top_influencers]
+    rows += [[], ['Top products', 'Units sold']]
+    rows += [[row['product__name'], row['sold']] for row in top_products]
+    return len(rows), iter(rows)
+
+
+REPORT_BUILDERS = {
+    'manage_orders': build_manage_orders_report,
+    'admin_dashboard': build_admin_dashboard_report,
+}
+
+
+# ---------- worker ----------
+
+def claim_report_job():
+    """
+    Lock the oldest queued job (or a running one whose worker stopped
+    beating) for this worker. started_at identifies this claim: updates from
+    a worker whose job was reclaimed match nothing.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = (
+            ReportJob.objects.select_for_update(skip_locked=True)
+            .filter(status=ReportJob.PENDING)
+            .order_by('created_at')
+            .first()
+        ) or (
+            ReportJob.objects.select_for_update(skip_locked=True)
+            .filter(status=ReportJob.RUNNING, heartbeat_at__lt=now - REPORT_HEARTBEAT_TIMEOUT)
+            .order_by('created_at')
+            .first()
+        )
+        if job is None:
+            return None
+        ReportJob.objects.filter(id=job.id).update(
+            status=ReportJob.RUNNING,
+            started_at=now,
+            heartbeat_at=now,
+            progress=0
+        )
+    job.status = ReportJob.RUNNING
+    job.started_at = job.heartbeat_at = now
+    return job
+
+
+def _claimed(job):
+    """The job's row, as long as this worker still holds the claim."""
+    return ReportJob.objects.filter(id=job.id, status=ReportJob.RUNNING, started_at=job.started_at)
+
+
+def _with_progress(job, total, rows):
+    """Pass rows through, writing progress and the heartbeat every PROGRESS_EVERY rows / HEARTBEAT_INTERVAL."""
+    done = 0
+    last_beat = time.monotonic()
+    for row in rows:
+        yield row
+        done += 1
+        if done % PROGRESS_EVERY == 0 or time.monotonic() - last_beat >= HEARTBEAT_INTERVAL:
+            progress = min(99, done * 100 // total) if total else 0
+            if not _claimed(job).update(progress=progress, heartbeat_at=timezone.now()):
+                raise ReportJobLost(job.id)
+            last_beat = time.monotonic()
+
+
+def run_report_job(job):
+    """Build the job's file under MEDIA_ROOT/reports/ and mark it done (or failed)."""
+    try:
+        total, rows = REPORT_BUILDERS[job.kind](job.params)
+        stream, _, extension = EXPORT_FORMATS[job.export_format]
+        with tempfile.TemporaryFile() as output:
+            for chunk in stream(_with_progress(job, total, rows)):
+                output.write(chunk.encode() if isinstance(chunk, str) else chunk)
+            output.seek(0)
+            filename = f"{job.kind}_{job.id}_{timezone.now():%Y%m%d_%H%M}.{extension}"
+            job.file.save(filename, File(output), save=False)
+    except ReportJobLost:
+        logger.warning('Report job %s was reclaimed by another worker', job.id)
+        return False
+    except Exception as e:
+        logger.exception('Report job %s failed', job.id)
+        _claimed(job).update(
+            status=ReportJob.FAILED,
+            error=repr(e),
+            finished_at=timezone.now()
+        )
+        return False
+
+    if not _claimed(job).update(
+        status=ReportJob.DONE,
+        progress=100,
+        file=job.file.name,
+        finished_at=timezone.now()
+    ):
+        logger.warning('Report job %s was reclaimed by another worker', job.id)
+        job.file.delete(save=False)
+        return False
+    return True
+
+
+def process_report_jobs(limit=None):
+    """Run queued jobs until there are none left (or `limit` ran); returns how many ran."""
+    ran = 0
+    while limit is None or ran < limit:
+        job = claim_report_job()
+        if job is None:
+            break
+        run_report_job(job)
+        ran += 1
+    return ran
+
+
+def run_report_worker(poll_interval=5.0, stop_event=None):
+    """Poll for report jobs until stop_event is set (or Ctrl-C)."""
+    stop_event = stop_event or threading.Event()
+    try:
+        while not stop_event.is_set():
+            close_old_connections()
+            try:
+                ran = process_report_jobs(limit=1)
+            except Exception:
+                logger.exception('Report worker crashed while claiming a job')
+                ran = 0
+            if not ran:
+                stop_event.wait(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_old_connections()
@@ -0,0 +1,65 @@
+# accounts/tests.py
+
+import csv
+import io
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+
+from .models import Order, ReportJob
+from .reports import process_report_jobs, report_params, request_report
+
+
+class ManageOrdersReportTests(TestCase):
+    """A background export of a searched order list has the searched orders only."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        User = get_user_model()
+        self.staff = User.objects.create_user(username='admin', password='x', is_staff=True)
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='x')
+        bob = User.objects.create_user(username='bob', email='bob@example.com', password='x')
+        # the search index is refreshed on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice_orders = [Order.objects.create(user=alice, total_amount=100) for _ in range(3)]
+            self.bob_order = Order.objects.create(user=bob, total_amount=100)
+
+    def _export(self, query):
+        job, created = request_report(self.staff, 'manage_orders', report_params(QueryDict(query)), 'csv')
+        self.assertTrue(created)
+        process_report_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.DONE)
+        with job.file.open('rb') as exported:
+            rows = list(csv.reader(io.StringIO(exported.read().decode('utf-8-sig'))))
+        # order rows run from the header to the blank line before the summary
+        return [int(row[0]) for row in rows[1:rows.index([])]]
+
+    def test_search_box_is_kept(self):
+        self.assertEqual(report_params(QueryDict('q=alice&page=2&format=csv')), {'q': 'alice'})
+
+    def test_searched_export_has_only_matching_orders(self):
+        exported = self._export('q=alice')
+
+        self.assertEqual(sorted(exported), sorted(order.id for order in self.alice_orders))
+
+    def test_search_combines_with_filters(self):
+        first = self.alice_orders[0]
+        Order.objects.filter(id__in=[first.id, self.bob_order.id]).update(status=Order.CANCELED)
+
+        self.assertEqual(self._export(f'q=alice&status={Order.CANCELED}'), [first.id])
@@ -1,4 +1,7 @@
 from django.contrib.auth.models import AbstractUser
+import uuid
+from decimal import Decimal
+
 from django.db import models
 from django.conf import settings
 # from .models import PRODUCT_MODEL
@@ -62,6 +65,13 @@ class InfluencerVideo(models.Model):
 from django.db import models
 from django.conf import settings
 
+def schedule_order_reindex(order_id):
+    """Refresh the order's search terms (accounts.order_search) once the current transaction commits."""
+    from django.db import transaction
+    from .order_search import index_orders
+    transaction.on_commit(lambda: index_orders([order_id]), robust=True)
+
+
 class OrderItem(models.Model):
     order = models.ForeignKey(
         "accounts.Order",      # referencing as a string fixes NameError
@@ -78,6 +88,14 @@ class OrderItem(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     price = models.DecimalField(max_digits=10, decimal_places=2)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        schedule_order_reindex(self.order_id)
+
+    def delete(self, *args, **kwargs):
+        schedule_order_reindex(self.order_id)
+        return super().delete(*args, **kwargs)
+
     def __str__(self):
         return f"{self.product.name} × {self.quantity}"
 
@@ -121,17 +139,36 @@ from django.conf import settings
 
 class Order(models.Model):
     PENDING = 'Pending'
-    COMPLETED = 'Completed'
+    COMPLETED = 'Completed'  # paid
     SHIPPED = 'Shipped'
+    DELIVERED = 'Delivered'
     CANCELED = 'Canceled'
 
     ORDER_STATUS_CHOICES = [
         (PENDING, 'Pending'),
         (COMPLETED, 'Completed'),
         (SHIPPED, 'Shipped'),
+        (DELIVERED, 'Delivered'),
         (CANCELED, 'Canceled'),
     ]
 
+    # Completed means paid; a paid order goes on to Shipped and Delivered, so
+    # revenue, earnings and invoices count all three
+    PAID_STATUSES = (COMPLETED, SHIPPED, DELIVERED)
+
+    # status -> statuses staff may move it to in a bulk transition.
+    # A paid (Completed) order still has to ship and be delivered.
+    ALLOWED_TRANSITIONS = {
+        PENDING: {SHIPPED, COMPLETED, CANCELED},
+        COMPLETED: {SHIPPED, DELIVERED, CANCELED},
+        SHIPPED: {COMPLETED, DELIVERED, CANCELED},
+        DELIVERED: set(),
+        CANCELED: set(),
+    }
+
+    # fields whose change refreshes the order's search terms (accounts.order_search)
+    SEARCH_FIELDS = {'user', 'address'}
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -160,47 +197,337 @@ class Order(models.Model):
         default=PENDING
     )
 
-    # def save(self, *args, **kwargs):
-    #     # Auto-calculate commission_amount before saving
-    #     if self.total_amount:
-    #         self.commission_amount = self.total_amount * (self.commission_percentage / 100)
+    # Affiliate code stamped into the session when the customer arrived via an influencer link
+    affiliate_code = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # manage_orders: newest first, optionally per status, paged on (created_at, id)
+            models.Index(fields=['status', 'created_at']),
+            # customer order history: one user's orders paged on (created_at, id)
+            models.Index(fields=['user', 'created_at', 'id']),
+            models.Index(fields=['created_at', 'id']),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot()
+        return instance
+
+    def _snapshot(self, fields=None):
+        # values as last loaded / saved; deferred fields are simply not in here
+        loaded = {
+            field.attname: self.__dict__[field.attname]
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__ and (fields is None or field.name in fields)
+        }
+        if fields is None:
+            self._loaded_values = loaded
+        else:
+            self._loaded_values = {**getattr(self, '_loaded_values', {}), **loaded}
+
+    def loaded_value(self, field_name):
+        """The value `field_name` had when the order was loaded or last saved."""
+        attname = self._meta.get_field(field_name).attname
+        return getattr(self, '_loaded_values', {}).get(attname, getattr(self, attname))
+
+    def get_dirty_fields(self):
+        """Names of the fields changed on this instance since it was loaded or last saved."""
+        loaded = getattr(self, '_loaded_values', {})
+        return [
+            field.name
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+            and (field.attname not in loaded or loaded[field.attname] != self.__dict__[field.attname])
+        ]
+
+    def status_changed(self):
+        return self.status != self.loaded_value('status')
+
+    def save(self, *args, **kwargs):
+        # Auto-calculate commission_amount before saving (skipped when .only() left
+        # the inputs deferred; loading them here would cost the SELECTs we avoid)
+        if not self.get_deferred_fields() & {'total_amount', 'commission_percentage'} and self.total_amount:
+            self.commission_amount = Decimal(str(self.total_amount)) * (Decimal(str(self.commission_percentage)) / Decimal('100'))
+
+        # Updates of a loaded order write only the columns that changed (no SELECT
+        # for the old values; they were captured in from_db)
+        if self.pk and not self._state.adding and kwargs.get('update_fields') is None \
+                and hasattr(self, '_loaded_values') and not kwargs.get('force_insert'):
+            dirty = self.get_dirty_fields()
+            if not dirty:
+                return
+            kwargs['update_fields'] = dirty + ['updated_at']
+
+        # new orders and changes to the searchable fields refresh the search index
+        reindex = self._state.adding or not self.SEARCH_FIELDS.isdisjoint(
+            kwargs.get('update_fields') or self.get_dirty_fields()
+        )
+        super().save(*args, **kwargs)
+        self._snapshot(kwargs.get('update_fields'))
+        if reindex:
+            schedule_order_reindex(self.pk)
+
+    def __str__(self):
+        return f"Order #{self.id} - {self.user.email} - ₹{self.total_amount}"
+
+    def get_status_display_choices(self):
+        return self.ORDER_STATUS_CHOICES
+
+
+class OrderStatusHistory(models.Model):
+    order = models.ForeignKey('accounts.Order', on_delete=models.CASCADE, related_name='status_history')
+    old_status = models.CharField(max_length=20)
+    new_status = models.CharField(max_length=20)
+    changed_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='order_status_changes'
+    )
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-changed_at']
+        indexes = [
+            models.Index(fields=['order', 'changed_at']),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.order_id}: {self.old_status} → {self.new_status}"
+
 
-def save(self, *args, **kwargs):
-        # Auto-calculate commission_amount before saving
-        if self.total_amount:
-            try:
-                commission_percentage = self.commission_percentage
-            except AttributeError:
-                commission_percentage = 20.0  # Default to 20% if field doesn't exist
-            self.commission_amount = self.total_amount * (commission_percentage / Decimal('100'))
+class OrderSearchTerm(models.Model):
+    """One searchable term of an order and its weight; maintained by accounts.order_search."""
+    order = models.ForeignKey('accounts.Order', on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=64, db_index=True)
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    def __str__(self):
+        return f"Order #{self.order_id}: {self.term}"
 
 
+class OrderEvent(models.Model):
+    """
+    Append-only log of order changes, written in the same transaction as the
+    change itself (transactional outbox). accounts.outbox relays it to consumers.
+    """
+    CREATED = 'order.created'
+    STATUS_CHANGED = 'order.status_changed'
 
-            # Check if status is being updated to Shipped or Completed
-        old_instance = None
-        if self.pk:  # If this is an update (not a new instance)
-            try:
-                old_instance = Order.objects.get(pk=self.pk)
-            except Order.DoesNotExist:
-                pass
+    id = models.BigAutoField(primary_key=True)
+    order = models.ForeignKey('accounts.Order', on_delete=models.CASCADE, related_name='events')
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.event_type} order #{self.order_id} ({self.id})"
+
+
+class OutboxCheckpoint(models.Model):
+    """How far each outbox consumer has got through OrderEvent."""
+    consumer = models.CharField(max_length=100, unique=True)
+    last_event_id = models.BigIntegerField(default=0)
+    # {event id: first seen (ISO time)} for ids below last_event_id that had
+    # not committed yet when the consumer passed them (see accounts/outbox.py)
+    pending = models.JSONField(default=dict, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.consumer} @ {self.last_event_id}"
 
 
+class ProcessedPayment(models.Model):
+    """
+    Idempotency record for a verified Razorpay payment.
+    Written in the same transaction as the Order it produced, so a retried or
+    double-submitted payment finds the existing Order instead of creating another.
+    """
+    razorpay_order_id = models.CharField(max_length=100, unique=True)
+    razorpay_payment_id = models.CharField(max_length=100, unique=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='processed_payments'
+    )
+    order = models.OneToOneField(
+        'accounts.Order',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='payment'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.razorpay_payment_id} → Order #{self.order_id}"
+
+
+class PaymentEvent(models.Model):
+    """
+    Durable queue of verified gateway webhook events.
+    The webhook view only inserts a row; orders.webhooks workers finalize them.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    DEAD = 'dead'
+
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (DEAD, 'Dead letter'),
+    ]
+
+    event_id = models.CharField(max_length=100, unique=True)
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(auto_now_add=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id} ({self.status})"
+
+
+def shipping_table_version_key():
+    return 'shipping_table_version'
+
+
+def get_shipping_table_version():
+    """Version stamp of the pincode -> zone table; each process reloads its copy when it changes."""
+    from django.core.cache import cache
+    cache.add(shipping_table_version_key(), uuid.uuid4().hex[:12], timeout=None)
+    return cache.get(shipping_table_version_key())
+
+
+def bump_shipping_table_version():
+    """Call after bulk imports of PincodeZone rows (save/delete already do)."""
+    from django.core.cache import cache
+    cache.set(shipping_table_version_key(), uuid.uuid4().hex[:12], timeout=None)
+
+
+class ShippingZone(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    courier_charge = models.DecimalField(max_digits=8, decimal_places=2)
+
+    def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
+        bump_shipping_table_version()
 
- # Auto-update influencer earnings after delivery
-        if old_instance and self.status in [self.SHIPPED, self.COMPLETED] and \
-           old_instance.status not in [self.SHIPPED, self.COMPLETED]:
-            # Calculate and update influencer earnings
-            for item in self.items.all():
-                if item.product and item.product.influencer:
-                    # In a real implementation, you might want to track influencer earnings
-                    # in a separate model or field. For now, we just log the action.
-                    pass
-
-def __str__(self):
-    return f"Order #{self.id} - {self.user.email} - ₹{self.total_amount}"
-    def get_status_display_choices(self):
-        return self.ORDER_STATUS_CHOICES
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        bump_shipping_table_version()
+        return result
+
+    def __str__(self):
+        return f"{self.name} (₹{self.courier_charge})"
+
+
+class PincodeZone(models.Model):
+    pincode = models.CharField(max_length=6, unique=True)
+    zone = models.ForeignKey(ShippingZone, on_delete=models.CASCADE, related_name='pincodes')
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_shipping_table_version()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        bump_shipping_table_version()
+        return result
+
+    def __str__(self):
+        return f"{self.pincode} → {self.zone.name}"
+
+
+class Invoice(models.Model):
+    """
+    PDF invoice for one version of an order (accounts.invoices). The version is
+    taken from Order.updated_at, so any change to the order gets a new file.
+    """
+    order = models.ForeignKey('accounts.Order', on_delete=models.CASCADE, related_name='invoices')
+    version = models.CharField(max_length=32)
+    file = models.FileField(upload_to='invoices/')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'version'], name='unique_invoice_version'),
+        ]
+
+    def __str__(self):
+        return f"Invoice for order #{self.order_id} ({self.version})"
+
+
+class ReportJob(models.Model):
+    """An admin export built in the background by accounts.reports workers."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True)
+    export_format = models.CharField(max_length=10, default='csv')
+    # sha256 of (kind, params, format); identical requests share one job
+    dedup_key = models.CharField(max_length=64, db_index=True)
+    requested_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        related_name='report_jobs'
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    progress = models.PositiveSmallIntegerField(default=0)  # percent
+    file = models.FileField(upload_to='reports/', blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # touched with every progress update; a running job that stops beating is reclaimed
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            # at most one queued / running job per identical request
+            models.UniqueConstraint(
+                fields=['dedup_key'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_active_report_job'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} ({self.export_format}) #{self.id} - {self.status} {self.progress}%"
 
 
 from django.db import models
@@ -355,3 +682,101 @@ class PromoVideo(models.Model):
         return self.title
 
 
+
+
+
+
+
+def affiliate_links_version_key(influencer_id):
+    return f'affiliate_links_version:{influencer_id}'
+
+
+def get_affiliate_links_version(influencer_id):
+    """
+    Current version stamp of an influencer's affiliate link list.
+    A missing cache entry simply starts a new version, so eviction only costs one rebuild.
+    """
+    from django.core.cache import cache
+    key = affiliate_links_version_key(influencer_id)
+    cache.add(key, uuid.uuid4().hex[:12], timeout=None)
+    return cache.get(key)
+
+
+def bump_affiliate_links_version(influencer_id):
+    from django.core.cache import cache
+    cache.set(affiliate_links_version_key(influencer_id), uuid.uuid4().hex[:12], timeout=None)
+
+
+class AffiliateRelationship(models.Model):
+    influencer = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='affiliate_relationships'
+    )
+    product = models.ForeignKey(
+        'products.Product',
+        on_delete=models.CASCADE,
+        related_name='affiliate_relationships'
+    )
+    code = models.CharField(max_length=64, unique=True)
+    affiliate_link = models.URLField(max_length=500)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('influencer', 'product')
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_affiliate_links_version(self.influencer_id)
+
+    def delete(self, *args, **kwargs):
+        influencer_id = self.influencer_id
+        result = super().delete(*args, **kwargs)
+        bump_affiliate_links_version(influencer_id)
+        return result
+
+    def __str__(self):
+        return f"{self.influencer.username} → {self.product.name} ({self.code})"
+
+
+class AffiliateClick(models.Model):
+    # Raw click log; only the hourly rollup job reads this table
+    relationship = models.ForeignKey(
+        AffiliateRelationship,
+        on_delete=models.CASCADE,
+        related_name='clicks'
+    )
+    session_key = models.CharField(max_length=40, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Click on {self.relationship.code} at {self.created_at}"
+
+
+class AffiliateRollup(models.Model):
+    influencer = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='affiliate_rollups'
+    )
+    product = models.ForeignKey(
+        'products.Product',
+        on_delete=models.CASCADE,
+        related_name='affiliate_rollups'
+    )
+    code = models.CharField(max_length=64)
+    hour = models.DateTimeField()
+    clicks = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+
+    class Meta:
+        ordering = ['-hour']
+        unique_together = ('code', 'hour')
+        indexes = [
+            models.Index(fields=['influencer', 'hour']),
+        ]
+
+    def __str__(self):
+        return f"{self.code} @ {self.hour:%Y-%m-%d %H:00} - {self.clicks} clicks, {self.orders} orders"
@@ -0,0 +1,369 @@
+# orders/cart.py
+#
+# Cart service: one query for the cart lines and their totals, plus a small
+# per-user cart summary (count + subtotal) cached for the navbar badge.
+#
+# Cart stores: the live cart is kept in a pluggable store (the session by
+# default) so +/- clicks don't write CartItem rows. Lines are persisted to
+# CartItem at checkout, or at most once per CART_PERSIST_DEBOUNCE seconds.
+
+import time
+from abc import ABC, abstractmethod
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.utils.module_loading import import_string
+
+from products.models import Product
+from .models import CartItem
+from .pricing import GST_RATE
+
+
+CART_SUMMARY_TIMEOUT = 60 * 15
+
+CART_SESSION_KEY = 'cart'
+CART_PERSIST_DEBOUNCE = getattr(settings, 'CART_PERSIST_DEBOUNCE', 300)  # seconds
+
+
+def cart_summary_key(user_id):
+    return f'cart_summary:{user_id}'
+
+
+def get_cart_lines(user):
+    """
+    Cart items of a user with their product and an annotated line_total,
+    fetched in a single query.
+    """
+    return (
+        CartItem.objects
+        .filter(user=user)
+        .select_related('product')
+        .annotate(
+            line_total=ExpressionWrapper(
+                F('product__price') * F('quantity'),
+                output_field=DecimalField(max_digits=12, decimal_places=2)
+            )
+        )
+    )
+
+
+def get_cart_totals(user):
+    """
+    Returns a dict with the evaluated cart lines, subtotal, GST and item count.
+    All figures come from the one query in get_cart_lines().
+    """
+    lines = list(get_cart_lines(user))
+    subtotal = sum((Decimal(line.line_total) for line in lines), Decimal('0.00'))
+    count = sum(line.quantity for line in lines)
+
+    return {
+        'cart_items': lines,
+        'subtotal': subtotal,
+        'gst_amount': subtotal * GST_RATE,
+        'count': count,
+    }
+
+
+def get_cart_summary(user):
+    """Cached {'count', 'subtotal'} for a user's cart; cheap enough to render on every page."""
+    key = cart_summary_key(user.id)
+    summary = cache.get(key)
+    if summary is None:
+        totals = CartItem.objects.filter(user=user).aggregate(
+            count=Sum('quantity'),
+            subtotal=Sum(
+                F('product__price') * F('quantity'),
+                output_field=DecimalField(max_digits=12, decimal_places=2)
+            ),
+        )
+        summary = {
+            'count': totals['count'] or 0,
+            'subtotal': totals['subtotal'] or Decimal('0.00'),
+        }
+        cache.set(key, summary, CART_SUMMARY_TIMEOUT)
+    return summary
+
+
+def invalidate_cart_summary(user):
+    """Call after any write to the user's CartItem rows."""
+    cache.delete(cart_summary_key(user.id))
+
+
+def persist_cart_lines(user, quantities):
+    """
+    Make the user's CartItem rows match {product_id: quantity}:
+    one DELETE for dropped lines, one bulk UPDATE and one bulk INSERT.
+    """
+    with transaction.atomic():
+        existing = {
+            item.product_id: item
+            for item in CartItem.objects.select_for_update().filter(user=user)
+        }
+
+        stale = [pid for pid in existing if pid not in quantities]
+        if stale:
+            CartItem.objects.filter(user=user, product_id__in=stale).delete()
+
+        changed = []
+        for pid, item in existing.items():
+            if pid in quantities and item.quantity != quantities[pid]:
+                item.quantity = quantities[pid]
+                changed.append(item)
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity'])
+
+        new_items = [
+            CartItem(user=user, product_id=pid, quantity=qty)
+            for pid, qty in quantities.items()
+            if pid not in existing
+        ]
+        if new_items:
+            CartItem.objects.bulk_create(new_items)
+
+    invalidate_cart_summary(user)
+
+
+def saved_cart_lines(user):
+    """The user's CartItem rows in cart store form, in one query."""
+    return {
+        str(item.product_id): {'quantity': item.quantity, 'price': str(item.product.price)}
+        for item in CartItem.objects.filter(user=user).select_related('product')
+    }
+
+
+class CartLine:
+    """CartItem-like row for templates (cart.html / checkout.html) built from a store line."""
+
+    def __init__(self, product, quantity):
+        self.id = product.id
+        self.product = product
+        self.quantity = quantity
+        self.line_total = product.price * quantity
+
+    def total_price(self):
+        return self.line_total
+
+
+class BaseCartStore(ABC):
+    """
+    Cart lines as {product_id: {'quantity': int, 'price': str}}.
+    The price is a snapshot for the navbar summary only; totals shown on the
+    cart and checkout pages are always recomputed from Product.price.
+    """
+
+    def __init__(self, user=None):
+        self.user = user if user is not None and user.is_authenticated else None
+
+    # -- storage hooks ------------------------------------------------------
+    @abstractmethod
+    def _load(self):
+        """The stored cart dict, or None if this store has never held a cart."""
+
+    @abstractmethod
+    def _save(self, data):
+        """Store the cart dict."""
+
+    # -- lines --------------------------------------------------------------
+    def _data(self):
+        data = self._load()
+        if data is None and self.user is not None:
+            # first read for a logged-in user (e.g. a session from before the
+            # cart store existed): start from their saved CartItem rows so the
+            # cart page and checkout see the same lines
+            data = {'lines': saved_cart_lines(self.user), 'persisted_at': time.time()}
+            self._save(data)
+        data = data or {}
+        data.setdefault('lines', {})
+        data.setdefault('persisted_at', 0)
+        return data
+
+    def lines(self):
+        return {int(pid): line for pid, line in self._data()['lines'].items()}
+
+    def quantities(self):
+        return {pid: line['quantity'] for pid, line in self.lines().items()}
+
+    def add(self, product, quantity=1):
+        data = self._data()
+        line = data['lines'].get(str(product.id), {'quantity': 0})
+        line['quantity'] += quantity
+        line['price'] = str(product.price)
+        data['lines'][str(product.id)] = line
+        self._write(data)
+
+    def update_quantity(self, product_id, quantity):
+        data = self._data()
+        if str(product_id) not in data['lines']:
+            return
+        if quantity < 1:
+            del data['lines'][str(product_id)]
+        else:
+            data['lines'][str(product_id)]['quantity'] = quantity
+        self._write(data)
+
+    def remove(self, product_id):
+        data = self._data()
+        if data['lines'].pop(str(product_id), None) is not None:
+            self._write(data)
+
+    def clear(self):
+        self._save({'lines': {}, 'persisted_at': time.time()})
+
+    def summary(self):
+        count = 0
+        subtotal = Decimal('0.00')
+        for line in self.lines().values():
+            count += line['quantity']
+            subtotal += Decimal(line.get('price', '0')) * line['quantity']
+        return {'count': count, 'subtotal': subtotal}
+
+    # -- persistence --------------------------------------------------------
+    def _write(self, data):
+        """Save the lines and persist them to CartItem if the debounce window has passed."""
+        data['dirty'] = True
+        if self.user is not None and time.time() - data['persisted_at'] >= CART_PERSIST_DEBOUNCE:
+            persist_cart_lines(self.user, {int(pid): line['quantity'] for pid, line in data['lines'].items()})
+            data['dirty'] = False
+            data['persisted_at'] = time.time()
+        self._save(data)
+
+    def persist(self):
+        """Write pending lines to CartItem now (checkout does this before building the order)."""
+        if self.user is None:
+            return
+        data = self._data()
+        if data.get('dirty'):
+            persist_cart_lines(self.user, {int(pid): line['quantity'] for pid, line in data['lines'].items()})
+            data['dirty'] = False
+            data['persisted_at'] = time.time()
+            self._save(data)
+
+    def merge_saved_cart(self, user):
+        """
+        On login: fold the user's saved CartItem rows into this (guest) cart.
+        A product in both keeps the larger quantity, so a cart that was already
+        persisted from this session is not doubled.
+        """
+        self.user = user
+        merged = self.lines()
+        for item in CartItem.objects.filter(user=user).select_related('product'):
+            line = merged.get(item.product_id)
+            if line is None or line['quantity'] < item.quantity:
+                merged[item.product_id] = {'quantity': item.quantity, 'price': str(item.product.price)}
+
+        data = self._data()
+        data['lines'] = {str(pid): line for pid, line in merged.items()}
+        data['dirty'] = True
+        self._save(data)
+        self.persist()
+
+    # -- reads --------------------------------------------------------------
+    def build(self):
+        """
+        Cart lines with current products and totals (same shape as get_cart_totals).
+        Products are loaded in one query and the price snapshots refreshed.
+        """
+        lines = self.lines()
+        products = Product.objects.in_bulk(list(lines))
+
+        cart_items = []
+        refreshed = {}
+        for pid, line in lines.items():
+            product = products.get(pid)
+            if product is None:
+                continue  # product was deleted since it was added
+            cart_items.append(CartLine(product, line['quantity']))
+            refreshed[pid] = {'quantity': line['quantity'], 'price': str(product.price)}
+
+        if refreshed != lines:
+            data = self._data()
+            data['lines'] = {str(pid): line for pid, line in refreshed.items()}
+            self._save(data)
+
+        subtotal = sum((line.line_total for line in cart_items), Decimal('0.00'))
+        return {
+            'cart_items': cart_items,
+            'subtotal': subtotal,
+            'gst_amount': subtotal * GST_RATE,
+            'count': sum(line.quantity for line in cart_items),
+        }
+
+
+class SessionCartStore(BaseCartStore):
+    """
+    Cart kept in request.session. With SESSION_ENGINE set to the cache or
+    cached_db backend this never touches the database between flushes.
+    """
+
+    def __init__(self, request):
+        super().__init__(request.user)
+        self.session = request.session
+
+    def _load(self):
+        return self.session.get(CART_SESSION_KEY)
+
+    def _save(self, data):
+        self.session[CART_SESSION_KEY] = data
+        self.session.modified = True
+
+
+class LocalCartStore(BaseCartStore):
+    """In-memory stand-in for tests and scripts."""
+
+    def __init__(self, request=None, user=None, data=None):
+        super().__init__(user if user is not None else getattr(request, 'user', None))
+        self.data = data if data is not None else {}
+
+    def _load(self):
+        return self.data
+
+    def _save(self, data):
+        self.data = data
+
+
+class DatabaseCartStore(BaseCartStore):
+    """The old behaviour: every change is written to CartItem straight away."""
+
+    def __init__(self, request):
+        super().__init__(request.user)
+
+    def _load(self):
+        if self.user is None:
+            return {}
+        return {'lines': saved_cart_lines(self.user), 'persisted_at': time.time()}
+
+    def _save(self, data):
+        if self.user is not None:
+            persist_cart_lines(self.user, {int(pid): line['quantity'] for pid, line in data['lines'].items()})
+
+    def _write(self, data):
+        self._save(data)
+
+    def persist(self):
+        pass
+
+    def summary(self):
+        if self.user is None:
+            return {'count': 0, 'subtotal': Decimal('0.00')}
+        return get_cart_summary(self.user)
+
+
+def get_cart_store(request):
+    """Cart store for this request; the class is configurable through settings.CART_STORE."""
+    store_class = import_string(getattr(settings, 'CART_STORE', 'orders.cart.SessionCartStore'))
+    return store_class(request)
+
+
+def cart_summary(request):
+    """
+    Context processor exposing cart_item_count / cart_subtotal to every template.
+    Add 'orders.cart.cart_summary' to TEMPLATES['OPTIONS']['context_processors'].
+    """
+    summary = get_cart_store(request).summary()
+    return {
+        'cart_item_count': summary['count'],
+        'cart_subtotal': summary['subtotal'],
+    }
@@ -0,0 +1,266 @@
+# orders/flashsale.py
+#
+# Flash-sale mode for products an influencer is promoting.
+#
+# - Admission queue: every shopper gets a ticket from an atomic cache counter
+#   (issued in arrival order). Tickets are admitted at FLASH_ADMIT_RATE per
+#   second since the sale started, so checkout / payment (and the database)
+#   see a bounded rate instead of everyone at once. The queue is bounded by
+#   FLASH_MAX_QUEUE; beyond that shoppers are told to come back.
+# - Stock shards: the product's stock is split over StockShard rows and each
+#   sale decrements one shard with a conditional UPDATE, so concurrent buyers
+#   don't all contend on the same row. Display stock is the sum of the shards;
+#   Product.stock is refreshed from it at most every FLASH_SYNC_INTERVAL seconds
+#   so listings stay roughly right without a write per sale on the hot row.
+#   No checkout holds are placed on flash-sale products: the queue decides.
+#   A product flagged is_flash_sale without shards (flag set by hand, sale
+#   never started) is sold like any other product.
+#
+# Start / end a sale with
+#     python manage.py flash_sale start <product id> [--shards N]
+#     python manage.py flash_sale end <product id>
+
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.http import JsonResponse
+from django.shortcuts import render
+from django.utils import timezone
+
+from products.models import Product, StockHold, StockShard
+
+
+FLASH_SHARDS = getattr(settings, 'FLASH_SALE_SHARDS', 8)
+FLASH_ADMIT_RATE = getattr(settings, 'FLASH_SALE_ADMIT_RATE', 20)  # shoppers per second
+FLASH_ADMIT_BURST = getattr(settings, 'FLASH_SALE_ADMIT_BURST', 50)  # admitted the moment the sale opens
+FLASH_MAX_QUEUE = getattr(settings, 'FLASH_SALE_MAX_QUEUE', 5000)
+FLASH_ADMISSION_TTL = getattr(settings, 'FLASH_SALE_ADMISSION_TTL', 60 * 10)  # seconds to finish checkout
+FLASH_SYNC_INTERVAL = getattr(settings, 'FLASH_SALE_SYNC_INTERVAL', 2)  # seconds
+
+ADMITTED = 'admitted'
+WAITING = 'waiting'
+QUEUE_FULL = 'full'
+SOLD_OUT = 'sold_out'
+
+
+# ---------- stock shards ----------
+
+def start_flash_sale(product, shards=FLASH_SHARDS):
+    """
+    Split the product's stock over `shards` rows and open the admission queue.
+    Existing checkout holds on the product are dropped; from now on the queue
+    decides who gets to buy.
+    """
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(id=product.id)
+        StockHold.objects.filter(product=product).delete()
+
+        base, extra = divmod(product.stock, shards)
+        StockShard.objects.filter(product=product).delete()
+        StockShard.objects.bulk_create([
+            StockShard(product=product, shard=i, stock=base + (1 if i < extra else 0))
+            for i in range(shards)
+        ])
+        Product.objects.filter(id=product.id).update(
+            is_flash_sale=True,
+            flash_sale_started_at=timezone.now(),
+            reserved=0
+        )
+
+    cache.delete_many([
+        queue_key(product.id), sold_out_key(product.id), shards_key(product.id), stock_key(product.id)
+    ])
+
+
+def end_flash_sale(product):
+    """Put the remaining shard stock back into Product.stock and close the sale."""
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(id=product.id)
+        shards = StockShard.objects.filter(product=product)
+        if shards.exists():
+            Product.objects.filter(id=product.id).update(stock=shards.aggregate(total=Sum('stock'))['total'])
+            shards.delete()
+        Product.objects.filter(id=product.id).update(is_flash_sale=False, flash_sale_started_at=None)
+
+    cache.delete_many([shards_key(product.id), stock_key(product.id)])
+
+
+def shard_total(product_id):
+    return StockShard.objects.filter(product_id=product_id).aggregate(total=Sum('stock'))['total'] or 0
+
+
+def sync_flash_stock(product_id, force=False):
+    """Copy the shard total into Product.stock, at most once per FLASH_SYNC_INTERVAL."""
+    if not force and not cache.add(f'flash_sync:{product_id}', 1, FLASH_SYNC_INTERVAL):
+        return
+    Product.objects.filter(id=product_id).update(stock=shard_total(product_id))
+
+
+def flash_product_ids(product_ids):
+    """The products among product_ids that are selling from shards."""
+    return set(
+        Product.objects.filter(id__in=list(product_ids), is_flash_sale=True, stock_shards__isnull=False)
+        .values_list('id', flat=True)
+        .distinct()
+    )
+
+
+def shards_key(product_id):
+    return f'flash_shards:{product_id}'
+
+
+def shard_numbers(product_id):
+    """The product's shard numbers, cached for the length of the sale."""
+    shards = cache.get(shards_key(product_id))
+    if shards is None:
+        shards = list(StockShard.objects.filter(product_id=product_id).values_list('shard', flat=True))
+        cache.set(shards_key(product_id), shards, 60 * 60)
+    return shards
+
+
+def take_from_shards(product_id, quantity):
+    """
+    Decrement `quantity` from one shard, starting at a random shard so buyers
+    spread out. If no single shard can cover it (near the end of a sale) the
+    quantity is gathered across shards under a short lock. Returns False when
+    the sale is sold out.
+    """
+    shards = shard_numbers(product_id)
+    start = random.randrange(len(shards)) if shards else 0
+    for shard in shards[start:] + shards[:start]:
+        if StockShard.objects.filter(
+            product_id=product_id,
+            shard=shard,
+            stock__gte=quantity
+        ).update(stock=F('stock') - quantity):
+            return True
+
+    with transaction.atomic():
+        rows = list(
+            StockShard.objects.select_for_update()
+            .filter(product_id=product_id, stock__gt=0)
+            .order_by('shard')
+        )
+        if sum(row.stock for row in rows) < quantity:
+            cache.set(sold_out_key(product_id), True, 5)
+            return False
+        needed = quantity
+        for row in rows:
+            take = min(row.stock, needed)
+            StockShard.objects.filter(id=row.id).update(stock=F('stock') - take)
+            needed -= take
+            if not needed:
+                break
+    return True
+
+
+def stock_key(product_id):
+    return f'flash_stock:{product_id}'
+
+
+def flash_stock(product_id):
+    """
+    Units left in a flash sale (sum of shards), or None if the product has no
+    shards. Cached for a second for the waiting room.
+    """
+    cached = cache.get(stock_key(product_id))
+    if cached is None:
+        shards = StockShard.objects.filter(product_id=product_id).aggregate(total=Sum('stock'), count=Count('id'))
+        cached = [shards['total'] if shards['count'] else None]
+        cache.set(stock_key(product_id), cached, 1)
+    return cached[0]
+
+
+# ---------- admission queue ----------
+
+def queue_key(product_id):
+    return f'flash_queue:{product_id}'
+
+
+def sold_out_key(product_id):
+    return f'flash_sold_out:{product_id}'
+
+
+def _ticket_session_key(product_id):
+    return f'flash_ticket:{product_id}'
+
+
+def _admission_session_key(product_id):
+    return f'flash_admitted:{product_id}'
+
+
+def admitted_until(product):
+    """Highest ticket number admitted so far; grows at FLASH_ADMIT_RATE per second."""
+    started = product.flash_sale_started_at or timezone.now()
+    elapsed = max((timezone.now() - started).total_seconds(), 0)
+    return FLASH_ADMIT_BURST + int(elapsed * FLASH_ADMIT_RATE)
+
+
+def is_admitted(request, product_id):
+    expires = request.session.get(_admission_session_key(product_id))
+    return bool(expires) and expires > time.time()
+
+
+def admit(request, product):
+    """
+    Where this shopper stands for a flash-sale product.
+    Returns (status, position); position is the number of tickets ahead.
+    """
+    if is_admitted(request, product.id):
+        return ADMITTED, 0
+    stock = flash_stock(product.id)
+    if stock is None:
+        return ADMITTED, 0  # no shards: the sale was never started, sold normally
+    if cache.get(sold_out_key(product.id)) or stock <= 0:
+        return SOLD_OUT, None
+
+    limit = admitted_until(product)
+    ticket = request.session.get(_ticket_session_key(product.id))
+    if ticket is None:
+        cache.add(queue_key(product.id), 0, timeout=None)
+        if (cache.get(queue_key(product.id)) or 0) - limit >= FLASH_MAX_QUEUE:
+            return QUEUE_FULL, None
+        ticket = cache.incr(queue_key(product.id))
+        request.session[_ticket_session_key(product.id)] = ticket
+
+    if ticket <= limit:
+        request.session[_admission_session_key(product.id)] = time.time() + FLASH_ADMISSION_TTL
+        return ADMITTED, 0
+    return WAITING, ticket - limit
+
+
+def waiting_room_response(request, product, status, position):
+    """The waiting-room page (or JSON for the page's polling XHR)."""
+    eta = int(position / FLASH_ADMIT_RATE) + 1 if position else None
+    context = {
+        'product': product,
+        'status': status,
+        'position': position,
+        'eta_seconds': eta,
+        'retry_after': min(eta or 5, 10),
+    }
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        response = JsonResponse({k: v for k, v in context.items() if k != 'product'})
+    else:
+        response = render(request, 'flash_sale_waiting.html', context)
+    response['Retry-After'] = str(context['retry_after'])
+    return response
+
+
+def flash_sale_gate(request, products):
+    """
+    None if the shopper may go on to checkout with these products, otherwise
+    the waiting-room response for the first flash-sale product they are not
+    admitted for yet.
+    """
+    for product in products:
+        if not product.is_flash_sale:
+            continue
+        status, position = admit(request, product)
+        if status != ADMITTED:
+            return waiting_room_response(request, product, status, position)
+    return None
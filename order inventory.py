@@ -0,0 +1,227 @@
+# orders/inventory.py
+#
+# Stock changes happen in the database, never read-modify-write in Python:
+# a conditional UPDATE ... SET stock = stock - q WHERE stock >= q either takes
+# the stock or touches no row, so two buyers can never both get the last unit.
+#
+# Checkout holds: from checkout onward a customer's lines are held in StockHold
+# rows for HOLD_MINUTES. Product.reserved always equals the sum of the hold rows,
+# so availability is stock - reserved and placing a hold is a single
+# conditional UPDATE on the product row. Like any UPDATE, it keeps that row
+# locked until the surrounding transaction commits, so hold_stock() and the
+# order transaction do nothing slow (no gateway calls) while they run.
+# Expired holds are given back by release_expired_holds(), run by
+#     python manage.py sweep_stock_holds
+# and also for a single product whenever a hold or sale finds it short.
+#
+# Products in a flash sale are sold from their stock shards instead and are
+# never held (see orders/flashsale.py).
+
+from datetime import timedelta
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from products.models import Product, StockHold
+from .flashsale import flash_product_ids, shard_total, sync_flash_stock, take_from_shards
+
+
+logger = logging.getLogger(__name__)
+
+HOLD_MINUTES = getattr(settings, 'STOCK_HOLD_MINUTES', 15)
+SWEEP_INTERVAL = 60  # seconds
+
+
+class InsufficientStock(ValueError):
+    """Raised when a product doesn't have enough stock left; views already handle ValueError."""
+
+    def __init__(self, product_id, requested, available=None, name=None):
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+        message = f"Not enough stock for {name or 'product #%s' % product_id}"
+        if available is not None:
+            message += f" (only {available} left)"
+        super().__init__(message)
+
+
+def _shortage(product_id, requested, available=None):
+    """InsufficientStock with the product's name and what is left, read once on the failure path."""
+    row = Product.objects.filter(id=product_id).values('name', 'stock', 'reserved').first()
+    if row is None:
+        return InsufficientStock(product_id, requested, available=0)
+    return InsufficientStock(
+        product_id,
+        requested,
+        available=max(row['stock'] - row['reserved'], 0) if available is None else available,
+        name=row['name']
+    )
+
+
+def decrement_stock(quantities, held=None):
+    """
+    Take {product_id: quantity} out of stock atomically.
+    held is {product_id: quantity} of this buyer's own holds, which are
+    consumed (taken out of reserved) in the same UPDATE; stock held by other
+    checkouts is never sold.
+    Products are updated in id order so concurrent checkouts lock rows in the
+    same order and can't deadlock. If any product is short the whole set is
+    rolled back and InsufficientStock is raised.
+    """
+    held = held or {}
+    flash = flash_product_ids(quantities)
+    with transaction.atomic():
+        for product_id in sorted(quantities):
+            quantity = quantities[product_id]
+            if product_id in flash:
+                if not take_from_shards(product_id, quantity):
+                    raise _shortage(product_id, quantity, available=shard_total(product_id))
+                continue
+            own = held.get(product_id, 0)
+            if not _take(product_id, quantity, own) and not (
+                release_expired_holds(product_ids=[product_id]) and _take(product_id, quantity, own)
+            ):
+                raise _shortage(product_id, quantity)
+
+    for product_id in flash:
+        sync_flash_stock(product_id)
+
+
+def _take(product_id, quantity, own):
+    """Sell `quantity`, consuming `own` units of the buyer's hold; False if short."""
+    return Product.objects.filter(
+        id=product_id,
+        stock__gte=F('reserved') - own + quantity
+    ).update(
+        stock=F('stock') - quantity,
+        reserved=F('reserved') - own
+    ) > 0
+
+
+def _reserve(product_id, quantity):
+    return Product.objects.filter(
+        id=product_id,
+        stock__gte=F('reserved') + quantity
+    ).update(reserved=F('reserved') + quantity) > 0
+
+
+def hold_stock(user, quantities, minutes=HOLD_MINUTES):
+    """
+    Make the user's holds match {product_id: quantity} and push their expiry
+    out by `minutes`. Only the difference to the existing hold is reserved, so
+    refreshing checkout doesn't churn the counters. Raises InsufficientStock
+    (and changes nothing) if some line can't be held. Flash-sale products
+    are not held.
+    """
+    expires_at = timezone.now() + timedelta(minutes=minutes)
+    flash = flash_product_ids(quantities)
+    quantities = {pid: qty for pid, qty in quantities.items() if pid not in flash}
+
+    with transaction.atomic():
+        existing = {
+            hold.product_id: hold
+            for hold in StockHold.objects.select_for_update().filter(user=user)
+        }
+
+        for product_id in sorted(quantities):
+            quantity = quantities[product_id]
+            current = existing[product_id].quantity if product_id in existing else 0
+            delta = quantity - current
+            if delta > 0:
+                if not _reserve(product_id, delta) and not (
+                    release_expired_holds(product_ids=[product_id], exclude_user=user)
+                    and _reserve(product_id, delta)
+                ):
+                    raise _shortage(product_id, quantity)
+            elif delta < 0:
+                Product.objects.filter(id=product_id).update(reserved=F('reserved') + delta)
+
+        dropped = {pid: hold.quantity for pid, hold in existing.items() if pid not in quantities}
+        _release(dropped)
+        StockHold.objects.filter(user=user, product_id__in=list(dropped)).delete()
+
+        kept = [hold for pid, hold in existing.items() if pid in quantities]
+        for hold in kept:
+            hold.quantity = quantities[hold.product_id]
+            hold.expires_at = expires_at
+        StockHold.objects.bulk_update(kept, ['quantity', 'expires_at'])
+        StockHold.objects.bulk_create([
+            StockHold(user=user, product_id=pid, quantity=qty, expires_at=expires_at)
+            for pid, qty in quantities.items()
+            if pid not in existing
+        ])
+
+
+def take_holds(user, product_ids):
+    """
+    Remove the user's holds on product_ids and return {product_id: quantity}
+    for decrement_stock(held=...). Call inside the order transaction.
+    Expired holds that the sweeper hasn't reached yet still count: they are
+    still included in Product.reserved.
+    """
+    holds = list(
+        StockHold.objects.select_for_update()
+        .filter(user=user, product_id__in=list(product_ids))
+    )
+    StockHold.objects.filter(id__in=[hold.id for hold in holds]).delete()
+    return {hold.product_id: hold.quantity for hold in holds}
+
+
+def release_expired_holds(batch_size=1000, product_ids=None, exclude_user=None):
+    """
+    Sweeper: bulk-release holds past their expiry (only on product_ids and
+    not exclude_user's, if given). One UPDATE per product and one DELETE per
+    batch; rows another transaction is consuming are skipped. Returns holds
+    released.
+    """
+    expired = StockHold.objects.filter(expires_at__lte=timezone.now())
+    if product_ids is not None:
+        expired = expired.filter(product_id__in=list(product_ids))
+    if exclude_user is not None:
+        expired = expired.exclude(user=exclude_user)
+    released = 0
+    while True:
+        with transaction.atomic():
+            holds = list(
+                expired.select_for_update(skip_locked=True)
+                .order_by('expires_at')[:batch_size]
+            )
+            if not holds:
+                return released
+
+            per_product = {}
+            for hold in holds:
+                per_product[hold.product_id] = per_product.get(hold.product_id, 0) + hold.quantity
+            _release(per_product)
+            StockHold.objects.filter(id__in=[hold.id for hold in holds]).delete()
+            released += len(holds)
+
+
+def run_hold_sweeper(interval=SWEEP_INTERVAL, stop_event=None):
+    """Release expired holds every `interval` seconds until stop_event is set (or Ctrl-C)."""
+    stop_event = stop_event or threading.Event()
+    try:
+        while not stop_event.is_set():
+            close_old_connections()
+            try:
+                released = release_expired_holds()
+                if released:
+                    logger.info('Released %s expired stock holds', released)
+            except Exception:
+                logger.exception('Stock hold sweep failed')
+            stop_event.wait(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_old_connections()
+
+
+def _release(quantities):
+    for product_id in sorted(quantities):
+        Product.objects.filter(id=product_id).update(reserved=F('reserved') - quantities[product_id])
+
@@ -0,0 +1,278 @@
+# orders/loadtest.py
+#
+# Load-test harness for concurrent checkouts. Shopper threads drive the real
+# views (add_to_cart -> checkout -> paymenthandler) through RequestFactory
+# against FakeGateway, on a few SKUs with limited stock, and the run reports
+# throughput, latency percentiles, oversell and lock-contention retries.
+#
+# Run it from `python manage.py shell` against a throwaway database:
+#
+#     from orders.loadtest import run_checkout_load
+#     print(run_checkout_load(shoppers=200, workers=20, skus=3, stock=50).report())
+#
+# settings.PAYMENT_GATEWAY must point at orders.payments.FakeGateway. Every run
+# creates its own users and products (prefixed "loadtest-"); cleanup() removes them.
+
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
+from django.db import OperationalError, close_old_connections
+from django.db.models import Sum
+from django.test import RequestFactory
+
+from products.models import Product
+from .models import Order, OrderItem
+from .payments import FakeGateway, gateway_order_key, get_gateway, percentile
+from . import views
+
+
+PREFIX = 'loadtest-'
+
+# results of one shopper's run
+COMPLETED = 'completed'
+SOLD_OUT = 'sold_out'    # checkout or payment refused for stock
+QUEUED = 'queued'        # flash-sale waiting room
+FAILED = 'failed'
+
+LOCK_ERRORS = ('deadlock', 'database is locked', 'lock wait timeout', 'could not serialize')
+
+
+class LoadTestResult:
+    def __init__(self, shoppers, workers, stock):
+        self.shoppers = shoppers
+        self.workers = workers
+        self.stock = stock  # {product_id: initial stock}
+        self.outcomes = {COMPLETED: 0, SOLD_OUT: 0, QUEUED: 0, FAILED: 0}
+        self.latencies = {'add_to_cart': [], 'checkout': [], 'paymenthandler': [], 'total': []}
+        self.retries = 0
+        self.lock_errors = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self.elapsed = 0.0
+        self.sold = {}
+        self.orders = 0
+
+    def record_lock_error(self, retried):
+        with self._lock:
+            self.lock_errors += 1
+            if retried:
+                self.retries += 1
+
+    @property
+    def orders_per_second(self):
+        return self.outcomes[COMPLETED] / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def oversold(self):
+        """Units sold beyond the initial stock, summed over SKUs (must be 0)."""
+        return sum(max(self.sold.get(pid, 0) - stock, 0) for pid, stock in self.stock.items())
+
+    def latency_percentiles(self, step):
+        values = sorted(self.latencies[step])
+        return {
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+            'max': values[-1] if values else None,
+        }
+
+    def as_dict(self):
+        return {
+            'shoppers': self.shoppers,
+            'workers': self.workers,
+            'elapsed_s': round(self.elapsed, 3),
+            'orders_per_second': round(self.orders_per_second, 2),
+            'outcomes': dict(self.outcomes),
+            'orders_created': self.orders,
+            'units_in_stock': sum(self.stock.values()),
+            'units_sold': sum(self.sold.values()),
+            'oversold': self.oversold,
+            'lock_errors': self.lock_errors,
+            'retries': self.retries,
+            'latency_ms': {step: self.latency_percentiles(step) for step in self.latencies},
+        }
+
+    def report(self):
+        data = self.as_dict()
+        lines = [
+            f"{data['shoppers']} shoppers on {data['workers']} workers in {data['elapsed_s']}s",
+            f"orders/sec: {data['orders_per_second']}  orders created: {data['orders_created']}",
+            'outcomes: ' + ', '.join(f'{k}={v}' for k, v in data['outcomes'].items()),
+            f"units sold: {data['units_sold']} of {data['units_in_stock']}  OVERSOLD: {data['oversold']}",
+            f"lock errors (deadlock / lock timeout): {data['lock_errors']}  retries: {data['retries']}",
+            'latency (ms)       p50       p95       p99       max',
+        ]
+        for step, values in data['latency_ms'].items():
+            lines.append(f'  {step:<15}' + ''.join(
+                f'{values[p]:>10.1f}' if values[p] is not None else f"{'-':>10}"
+                for p in ('p50', 'p95', 'p99', 'max')
+            ))
+        for error in self.errors[:5]:
+            lines.append(f'error: {error}')
+        return '\n'.join(lines)
+
+
+class Shopper:
+    """One customer with a persistent session, calling the order views directly."""
+
+    def __init__(self, user, factory):
+        self.user = user
+        self.factory = factory
+        self.session = import_module(settings.SESSION_ENGINE).SessionStore()
+
+    def request(self, method, path='/', data=None):
+        request = getattr(self.factory, method)(path, data or {})
+        request.user = self.user
+        request.session = self.session
+        request._messages = FallbackStorage(request)
+        return request
+
+    def call(self, view, method='get', data=None, *args):
+        response = view(self.request(method, data=data), *args)
+        self.session.save()
+        return response
+
+
+def setup_load_test(shoppers, skus=3, stock=50, price=Decimal('499.00')):
+    """Create the seller, products and shopper accounts for one run."""
+    User = get_user_model()
+    run = uuid.uuid4().hex[:8]
+    seller = User.objects.create(username=f'{PREFIX}{run}-seller', user_type='influencer')
+    products = [
+        Product.objects.create(
+            influencer=seller,
+            name=f'{PREFIX}{run}-sku{i}',
+            description='load test product',
+            price=price,
+            stock=stock
+        )
+        for i in range(skus)
+    ]
+    users = User.objects.bulk_create([
+        User(username=f'{PREFIX}{run}-{i}', user_type='customer')
+        for i in range(shoppers)
+    ])
+    if users and users[0].pk is None:  # backends that don't return ids from bulk_create
+        users = list(User.objects.filter(username__startswith=f'{PREFIX}{run}-').exclude(id=seller.id))
+    return products, users
+
+
+def cleanup():
+    """Remove everything run_checkout_load() created."""
+    User = get_user_model()
+    Order.objects.filter(user__username__startswith=PREFIX).delete()
+    Product.objects.filter(name__startswith=PREFIX).delete()
+    User.objects.filter(username__startswith=PREFIX).delete()
+
+
+def _is_lock_error(text):
+    text = text.lower()
+    return any(marker in text for marker in LOCK_ERRORS)
+
+
+def _timed(result, step, fn, *args):
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        result.latencies[step].append((time.perf_counter() - started) * 1000)
+
+
+def run_shopper(shopper, products, result, max_quantity=2, max_retries=3, think_time=0):
+    """add_to_cart -> checkout -> pay -> paymenthandler for one shopper; returns the outcome."""
+    close_old_connections()
+    gateway = get_gateway()
+    started = time.perf_counter()
+    try:
+        product = random.choice(products)
+        for _ in range(random.randint(1, max_quantity)):
+            _timed(result, 'add_to_cart', shopper.call, views.add_to_cart, 'get', None, product.id)
+
+        for attempt in range(max_retries + 1):
+            try:
+                response = _timed(result, 'checkout', shopper.call, views.checkout)
+            except OperationalError as e:
+                if not _is_lock_error(str(e)) or attempt == max_retries:
+                    raise
+                result.record_lock_error(retried=True)
+                continue
+            break
+
+        if response.status_code == 302:
+            return SOLD_OUT  # stock couldn't be held; sent back to the cart
+        if response.status_code != 200 or 'Retry-After' in response:
+            return QUEUED if 'Retry-After' in response else FAILED
+
+        gateway_order = cache.get(gateway_order_key(shopper.user.id))
+        if not gateway_order:
+            return FAILED  # gateway unavailable on the checkout page
+        if think_time:
+            time.sleep(random.uniform(0, think_time))
+        params = gateway.pay(gateway_order['order_id'])
+
+        for attempt in range(max_retries + 1):
+            response = _timed(result, 'paymenthandler', shopper.call, views.paymenthandler, 'post', params)
+            if response.status_code == 500 and _is_lock_error(response.content.decode(errors='replace')):
+                result.record_lock_error(retried=attempt < max_retries)
+                if attempt < max_retries:
+                    continue
+            break
+
+        if response.status_code == 302:
+            return COMPLETED
+        if response.status_code == 400:
+            return SOLD_OUT
+        result.errors.append(f'paymenthandler {response.status_code}: {response.content[:200]!r}')
+        return FAILED
+    except Exception as e:
+        if _is_lock_error(str(e)):
+            result.record_lock_error(retried=False)
+        result.errors.append(repr(e))
+        return FAILED
+    finally:
+        result.latencies['total'].append((time.perf_counter() - started) * 1000)
+        close_old_connections()
+
+
+def run_checkout_load(shoppers=100, workers=10, skus=3, stock=50, max_quantity=2,
+                      max_retries=3, think_time=0):
+    """
+    Run `shoppers` checkouts on `workers` threads against `skus` products with
+    `stock` units each and return a LoadTestResult. Ask for more units than
+    exist (shoppers * max_quantity > skus * stock) to exercise the last-unit
+    race; `oversold` must stay 0.
+    """
+    if not isinstance(get_gateway(), FakeGateway):
+        raise RuntimeError("Load tests need settings.PAYMENT_GATEWAY = 'orders.payments.FakeGateway'")
+
+    products, users = setup_load_test(shoppers, skus=skus, stock=stock)
+    result = LoadTestResult(shoppers, workers, {product.id: stock for product in products})
+    factory = RequestFactory()
+    shopper_list = [Shopper(user, factory) for user in users]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='loadtest') as pool:
+        futures = [
+            pool.submit(run_shopper, shopper, products, result, max_quantity, max_retries, think_time)
+            for shopper in shopper_list
+        ]
+        for future in futures:
+            result.outcomes[future.result()] += 1
+    result.elapsed = time.perf_counter() - started
+
+    result.sold = dict(
+        OrderItem.objects.filter(product__in=products)
+        .values_list('product_id')
+        .annotate(total=Sum('quantity'))
+    )
+    result.orders = Order.objects.filter(user__in=users).count()
+    return result
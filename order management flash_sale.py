@@ -0,0 +1,34 @@
+# orders/management/commands/flash_sale.py
+#
+#     python manage.py flash_sale start 42 --shards 16
+#     python manage.py flash_sale end 42
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.flashsale import FLASH_SHARDS, end_flash_sale, flash_stock, start_flash_sale
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Start or end a flash sale on a product.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['start', 'end'])
+        parser.add_argument('product_id', type=int)
+        parser.add_argument('--shards', type=int, default=FLASH_SHARDS, help='Stock shards to split the product over.')
+
+    def handle(self, *args, **options):
+        try:
+            product = Product.objects.get(id=options['product_id'])
+        except Product.DoesNotExist:
+            raise CommandError(f"Product {options['product_id']} does not exist")
+
+        if options['action'] == 'start':
+            if options['shards'] < 1:
+                raise CommandError('--shards must be at least 1')
+            start_flash_sale(product, shards=options['shards'])
+            self.stdout.write(f"Flash sale started on {product.name}: {flash_stock(product.id)} units over {options['shards']} shards")
+        else:
+            end_flash_sale(product)
+            product.refresh_from_db(fields=['stock'])
+            self.stdout.write(f"Flash sale ended on {product.name}: {product.stock} units back in stock")
@@ -0,0 +1,26 @@
+# orders/management/commands/run_payment_workers.py
+#
+#     python manage.py run_payment_workers                    # keep finalizing queued webhooks
+#     python manage.py run_payment_workers --concurrency 8
+#     python manage.py run_payment_workers --once             # single batch, e.g. from cron
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.webhooks import process_pending_events, run_payment_workers
+
+
+class Command(BaseCommand):
+    help = 'Finalize orders from queued payment webhooks (PaymentEvent), with retries and dead-lettering.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='Worker threads.')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls when idle.')
+        parser.add_argument('--once', action='store_true', help='Process one batch and exit.')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            self.stdout.write(f"Processed {process_pending_events()} payment events")
+            return
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        run_payment_workers(concurrency=options['concurrency'], poll_interval=options['interval'])
@@ -0,0 +1,22 @@
+# orders/management/commands/sweep_stock_holds.py
+#
+#     python manage.py sweep_stock_holds            # keep sweeping (one process is enough)
+#     python manage.py sweep_stock_holds --once     # single pass, e.g. from cron
+
+from django.core.management.base import BaseCommand
+
+from orders.inventory import SWEEP_INTERVAL, release_expired_holds, run_hold_sweeper
+
+
+class Command(BaseCommand):
+    help = 'Give expired checkout stock holds back to the products they reserve.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=SWEEP_INTERVAL, help='Seconds between sweeps.')
+        parser.add_argument('--once', action='store_true', help='Sweep once and exit.')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            self.stdout.write(f"Released {release_expired_holds()} expired holds")
+            return
+        run_hold_sweeper(interval=options['interval'])
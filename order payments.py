@@ -0,0 +1,515 @@
+# orders/payments.py
+#
+# Payment gateway access for checkout / paymenthandler.
+# The gateway class is pluggable (settings.PAYMENT_GATEWAY) so checkout can be
+# exercised offline against FakeGateway, which signs payments the same way
+# Razorpay does.
+#
+# One gateway instance is shared by the whole process: its HTTP session keeps
+# connections alive, every call has a timeout, and a circuit breaker stops us
+# queueing web workers behind a gateway that is down.
+#
+# Each gateway order carries what checkout was priced for in its notes
+# (customer, delivery address, affiliate code), so finalize_payment() gives
+# the same order whether paymenthandler or the webhook worker gets there first.
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from accounts.models import OrderEvent, ProcessedPayment
+from accounts.order_status import change_order_status
+from products.models import Product
+from .cart import invalidate_cart_summary
+from .inventory import decrement_stock, take_holds
+from .models import CartItem, Order, OrderItem
+
+
+# Razorpay keeps an unpaid order open far longer; we just stop reusing ours after this
+GATEWAY_ORDER_TTL = getattr(settings, 'GATEWAY_ORDER_TTL', 60 * 30)  # seconds
+
+
+GATEWAY_CONNECT_TIMEOUT = getattr(settings, 'PAYMENT_GATEWAY_CONNECT_TIMEOUT', 2)  # seconds
+GATEWAY_READ_TIMEOUT = getattr(settings, 'PAYMENT_GATEWAY_READ_TIMEOUT', 5)  # seconds
+GATEWAY_POOL_SIZE = getattr(settings, 'PAYMENT_GATEWAY_POOL_SIZE', 20)
+BREAKER_FAILURE_THRESHOLD = getattr(settings, 'PAYMENT_GATEWAY_FAILURE_THRESHOLD', 5)
+BREAKER_RESET_TIMEOUT = getattr(settings, 'PAYMENT_GATEWAY_RESET_TIMEOUT', 30)  # seconds
+# how long checkout waits for the gateway after its own DB work is done
+GATEWAY_WAIT_TIMEOUT = getattr(settings, 'PAYMENT_GATEWAY_WAIT_TIMEOUT', GATEWAY_CONNECT_TIMEOUT + GATEWAY_READ_TIMEOUT)
+
+
+class PaymentVerificationError(Exception):
+    pass
+
+
+class GatewayUnavailable(Exception):
+    """The gateway timed out, errored, or the circuit breaker is open; checkout should degrade."""
+
+
+class CircuitBreaker:
+    """
+    closed → open after `failure_threshold` consecutive failures; while open every
+    call fails fast. After `reset_timeout` one trial call is let through
+    (half-open): success closes the breaker, failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True  # the single trial call
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class GatewayMetrics:
+    """Per-operation call counts, failures and recent latencies (ms) for the admin / logs."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._ops = {}
+
+    def _op(self, operation):
+        return self._ops.setdefault(operation, {
+            'calls': 0, 'failures': 0, 'rejected': 0, 'latencies': deque(maxlen=self.window),
+        })
+
+    def record(self, operation, elapsed_ms, ok):
+        with self._lock:
+            op = self._op(operation)
+            op['calls'] += 1
+            if not ok:
+                op['failures'] += 1
+            op['latencies'].append(elapsed_ms)
+
+    def record_rejected(self, operation):
+        with self._lock:
+            self._op(operation)['rejected'] += 1
+
+    def snapshot(self):
+        result = {}
+        with self._lock:
+            for name, op in self._ops.items():
+                latencies = sorted(op['latencies'])
+                result[name] = {
+                    'calls': op['calls'],
+                    'failures': op['failures'],
+                    'rejected': op['rejected'],
+                    'p50_ms': percentile(latencies, 0.50),
+                    'p95_ms': percentile(latencies, 0.95),
+                    'p99_ms': percentile(latencies, 0.99),
+                }
+        return result
+
+
+def build_http_session(pool_size=GATEWAY_POOL_SIZE, connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+                       read_timeout=GATEWAY_READ_TIMEOUT):
+    """requests.Session with a keep-alive pool and a default (connect, read) timeout on every call."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class TimeoutSession(requests.Session):
+        def request(self, *args, **kwargs):
+            kwargs.setdefault('timeout', (connect_timeout, read_timeout))
+            return super().request(*args, **kwargs)
+
+    session = TimeoutSession()
+    # no urllib3 retries: a retried POST could create a second gateway order
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class RazorpayGateway:
+    def __init__(self, base_url=None, session=None, breaker=None, metrics=None):
+        import razorpay
+        self.key_id = settings.RAZORPAY_KEY_ID
+        options = {}
+        base_url = base_url or getattr(settings, 'RAZORPAY_BASE_URL', None)
+        if base_url:
+            options['base_url'] = base_url  # e.g. a local stub server in tests
+        self.client = razorpay.Client(
+            session=session or build_http_session(),
+            auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET),
+            **options
+        )
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics or GatewayMetrics()
+
+    def _call(self, operation, fn, *args, **kwargs):
+        if not self.breaker.allow():
+            self.metrics.record_rejected(operation)
+            raise GatewayUnavailable(f'{operation}: circuit open')
+
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.metrics.record(operation, (time.monotonic() - started) * 1000, ok=False)
+            self.breaker.record_failure()
+            raise GatewayUnavailable(f'{operation}: {e}') from e
+
+        self.metrics.record(operation, (time.monotonic() - started) * 1000, ok=True)
+        self.breaker.record_success()
+        return result
+
+    def create_order(self, amount_paise, currency='INR', receipt=None, notes=None):
+        data = dict(amount=amount_paise, currency=currency, payment_capture='1')  # auto-capture
+        if receipt:
+            data['receipt'] = receipt
+        if notes:
+            data['notes'] = notes
+        return self._call('order.create', self.client.order.create, data)
+
+    def verify_payment_signature(self, params):
+        try:
+            self.client.utility.verify_payment_signature(params)
+        except Exception as e:
+            raise PaymentVerificationError(str(e))
+
+    def verify_webhook_signature(self, body, signature):
+        try:
+            self.client.utility.verify_webhook_signature(
+                body.decode('utf-8'), signature, settings.RAZORPAY_WEBHOOK_SECRET
+            )
+        except Exception as e:
+            raise PaymentVerificationError(str(e))
+
+
+class FakeGateway:
+    """
+    Offline stand-in for Razorpay. Orders live in memory and payments are
+    signed with HMAC-SHA256(order_id|payment_id, secret), like the real thing.
+    """
+
+    # shared by every instance so get_gateway() calls see the same orders
+    orders = {}
+
+    def __init__(self, secret='fake_secret', webhook_secret='fake_webhook_secret'):
+        self.key_id = 'rzp_test_fake'
+        self.secret = secret
+        self.webhook_secret = webhook_secret
+
+    def create_order(self, amount_paise, currency='INR', receipt=None, notes=None):
+        order = {
+            'id': f'order_fake_{uuid.uuid4().hex[:14]}',
+            'entity': 'order',
+            'amount': amount_paise,
+            'currency': currency,
+            'receipt': receipt,
+            'notes': notes or {},
+            'status': 'created',
+        }
+        self.orders[order['id']] = order
+        return order
+
+    def sign(self, razorpay_order_id, razorpay_payment_id):
+        message = f'{razorpay_order_id}|{razorpay_payment_id}'.encode()
+        return hmac.new(self.secret.encode(), message, hashlib.sha256).hexdigest()
+
+    def pay(self, razorpay_order_id):
+        """Simulate the customer paying; returns the params checkout.html would post."""
+        payment_id = f'pay_fake_{uuid.uuid4().hex[:14]}'
+        self.orders[razorpay_order_id]['status'] = 'paid'
+        return {
+            'razorpay_order_id': razorpay_order_id,
+            'razorpay_payment_id': payment_id,
+            'razorpay_signature': self.sign(razorpay_order_id, payment_id),
+        }
+
+    def verify_payment_signature(self, params):
+        expected = self.sign(params['razorpay_order_id'], params['razorpay_payment_id'])
+        if not hmac.compare_digest(expected, params.get('razorpay_signature', '')):
+            raise PaymentVerificationError('Razorpay Signature Verification Failed')
+
+    def webhook_event(self, razorpay_order_id, razorpay_payment_id, event='order.paid'):
+        """
+        Build the webhook request Razorpay would send for a paid order.
+        Returns (body, headers) ready for RequestFactory / the test client.
+        """
+        order = self.orders[razorpay_order_id]
+        body = json.dumps({
+            'entity': 'event',
+            'event': event,
+            'payload': {
+                'order': {'entity': order},
+                'payment': {'entity': {
+                    'id': razorpay_payment_id,
+                    'order_id': razorpay_order_id,
+                    'amount': order['amount'],
+                    'status': 'captured',
+                    'notes': {},
+                }},
+            },
+        }).encode()
+        headers = {
+            'HTTP_X_RAZORPAY_SIGNATURE': hmac.new(self.webhook_secret.encode(), body, hashlib.sha256).hexdigest(),
+            'HTTP_X_RAZORPAY_EVENT_ID': f'evt_fake_{uuid.uuid4().hex[:14]}',
+        }
+        return body, headers
+
+    def verify_webhook_signature(self, body, signature):
+        expected = hmac.new(self.webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature or ''):
+            raise PaymentVerificationError('Razorpay Webhook Signature Verification Failed')
+
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+
+def get_gateway():
+    """The process-wide gateway instance (one HTTP pool, breaker and metrics per process)."""
+    path = getattr(settings, 'PAYMENT_GATEWAY', 'orders.payments.RazorpayGateway')
+    gateway = _gateways.get(path)
+    if gateway is None:
+        with _gateways_lock:
+            gateway = _gateways.get(path)
+            if gateway is None:
+                gateway = _gateways[path] = import_string(path)()
+    return gateway
+
+
+def checkout_fingerprint(lines, grand_total, address_id=None, affiliate_code=None):
+    """
+    Hash of what the customer is about to pay for.
+    lines is an iterable of (product_id, quantity, unit_price).
+    """
+    payload = json.dumps({
+        'lines': sorted((int(pid), int(qty), str(price)) for pid, qty, price in lines),
+        'address': address_id,
+        'affiliate': affiliate_code,
+        'total': str(grand_total),
+    })
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def gateway_order_key(user_id):
+    return f'gateway_order:{user_id}'
+
+
+def checkout_notes(user, address=None, affiliate_code=None, buy_now=None):
+    """
+    Gateway order notes the webhook worker finalizes from (Razorpay notes are
+    strings). buy_now is the {product_id: quantity} of a buy-now checkout.
+    """
+    notes = {'user_id': str(user.id)}
+    if address is not None:
+        notes['address_id'] = str(address.id)
+    if affiliate_code:
+        notes['affiliate_code'] = affiliate_code
+    if buy_now:
+        notes['buy_now'] = ','.join(f'{product_id}:{quantity}' for product_id, quantity in buy_now.items())
+    return notes
+
+
+def buy_now_lines(notes):
+    """{product_id: quantity} from checkout_notes(buy_now=...), or None for a cart checkout."""
+    if not notes.get('buy_now'):
+        return None
+    return {
+        int(product_id): int(quantity)
+        for product_id, quantity in (line.split(':') for line in notes['buy_now'].split(','))
+    }
+
+
+def get_or_create_gateway_order(user, fingerprint, amount_paise, gateway=None, notes=None):
+    """
+    Return the gateway order id for this checkout, creating a gateway order
+    only when the cart / address / total changed since the last page load.
+    One open gateway order is remembered per user. notes (checkout_notes())
+    must be covered by the fingerprint.
+    """
+    key = gateway_order_key(user.id)
+    cached = cache.get(key)
+    if cached and cached['fingerprint'] == fingerprint:
+        return cached['order_id']
+
+    gateway = gateway or get_gateway()
+    gateway_order = gateway.create_order(
+        amount_paise,
+        receipt=f'user-{user.id}-{fingerprint[:12]}',
+        notes=notes or checkout_notes(user)
+    )
+    cache.set(key, {'fingerprint': fingerprint, 'order_id': gateway_order['id']}, GATEWAY_ORDER_TTL)
+    return gateway_order['id']
+
+
+# Gateway calls made off the request thread so checkout can do its DB reads meanwhile
+gateway_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'PAYMENT_GATEWAY_THREADS', GATEWAY_POOL_SIZE),
+    thread_name_prefix='gateway'
+)
+
+
+def submit_gateway_order(user, fingerprint, amount_paise, gateway=None, notes=None):
+    """Start get_or_create_gateway_order() on the gateway thread pool; returns a Future."""
+    return gateway_executor.submit(get_or_create_gateway_order, user, fingerprint, amount_paise, gateway, notes)
+
+
+def wait_gateway_order(future, timeout=GATEWAY_WAIT_TIMEOUT):
+    """
+    Result of submit_gateway_order(). Raises GatewayUnavailable if it failed or
+    didn't finish within `timeout`; a call still queued is cancelled, one in
+    flight is cut off by the HTTP read timeout.
+    """
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise GatewayUnavailable('order.create: timed out waiting for the gateway')
+
+
+def forget_gateway_order(user):
+    """Drop the remembered gateway order once it has been paid."""
+    cache.delete(gateway_order_key(user.id))
+
+
+# ---------- turning a payment into an order ----------
+
+def create_order_from_cart(user, address=None, affiliate_code=None, lines=None):
+    """
+    Create Order + OrderItems for the user's cart, or for `lines`
+    ({product_id: quantity}) instead when it is a buy-now checkout.
+    affiliate_code is the influencer link code stamped in the session (if any).
+    Returns (order, message) or raises Exception on stock problems.
+    """
+    if lines:
+        products = Product.objects.in_bulk(list(lines))
+        if len(products) != len(lines):
+            raise ValueError("Product no longer available")
+        order_lines = [(products[product_id], quantity) for product_id, quantity in lines.items()]
+    else:
+        order_lines = [
+            (item.product, item.quantity)
+            for item in CartItem.objects.filter(user=user).select_related('product')
+        ]
+    if not order_lines:
+        raise ValueError("Cart is empty")
+
+    quantities = {}
+    for product, quantity in order_lines:
+        quantities[product.id] = quantities.get(product.id, 0) + quantity
+    total = sum((Decimal(quantity) * Decimal(product.price) for product, quantity in order_lines), Decimal('0.00'))
+
+    # Use atomic transaction to keep consistency
+    with transaction.atomic():
+        # Conditional UPDATE per product, consuming this user's checkout holds;
+        # raises (and rolls back) if any is short
+        held = take_holds(user, quantities)
+        decrement_stock(quantities, held=held)
+
+        # keep as Pending until payment verified
+        order = Order.objects.create(
+            user=user,
+            address=address,
+            total_amount=total,
+            status=Order.PENDING,
+            affiliate_code=affiliate_code
+        )
+
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=product,
+                quantity=quantity,
+                price=product.price
+            )
+            for product, quantity in order_lines
+        ])
+        OrderEvent.objects.create(
+            order=order,
+            event_type=OrderEvent.CREATED,
+            payload={'user': user.id, 'total_amount': str(total), 'affiliate_code': affiliate_code}
+        )
+        # don't delete cart_items here — we'll clear them after successful payment
+        return order
+
+
+def finalize_payment(user, razorpay_order_id, payment_id, address=None, affiliate_code=None, lines=None):
+    """
+    Turn a verified payment into a completed Order exactly once.
+    Returns (order, created). A retry / double submit of the same payment gets
+    the Order created the first time, without touching the cart or stock again.
+    lines ({product_id: quantity}) is a buy-now checkout: that is what gets
+    ordered and the cart is left alone.
+    """
+    existing = (
+        ProcessedPayment.objects
+        .filter(razorpay_order_id=razorpay_order_id, order__isnull=False)
+        .select_related('order')
+        .first()
+    )
+    if existing:
+        return existing.order, False
+
+    with transaction.atomic():
+        # The unique razorpay_order_id makes a concurrent duplicate wait here
+        # until the first request commits, then it sees the finished record.
+        record, created = ProcessedPayment.objects.select_for_update().get_or_create(
+            razorpay_order_id=razorpay_order_id,
+            defaults={'razorpay_payment_id': payment_id, 'user': user}
+        )
+        if record.order_id:
+            return record.order, False
+
+        # create order and items (this will reserve stock)
+        order = create_order_from_cart(user, address=address, affiliate_code=affiliate_code, lines=lines)
+
+        # mark order paid/completed
+        change_order_status(order, Order.COMPLETED, changed_by=user)
+
+        record.order = order
+        record.save(update_fields=['order'])
+
+        # clear user's cart
+        if not lines:
+            CartItem.objects.filter(user=user).delete()
+
+    invalidate_cart_summary(user)
+    # the gateway order is paid; the next checkout needs a fresh one
+    forget_gateway_order(user)
+    return order, True
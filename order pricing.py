@@ -0,0 +1,199 @@
+# orders/pricing.py
+#
+# Checkout pricing: subtotal, tax lines, shipping and grand total for a set of
+# cart lines, all in Decimal and rounded to the paisa. The cart page, checkout
+# and the admin / abandoned-cart jobs all quote through here so they show the
+# same figures.
+#
+# Tax and shipping tables come from settings and are built once per process
+# (reload_pricing_tables() after changing them at runtime).
+#
+# Courier charges by destination: the PincodeZone table is loaded into a
+# {pincode: zone} dict per process, so a quote is one dict lookup. A version
+# stamp in the cache (bumped whenever the admin edits a zone or pincode) tells
+# each process when to reload. Pincodes not in the table use SHIPPING_RATES.
+
+import re
+import threading
+from decimal import ROUND_HALF_UP, Decimal
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import DecimalField, F, Sum
+
+from accounts.models import PincodeZone, ShippingZone, get_shipping_table_version
+from .models import Address, CartItem
+
+
+PAISA = Decimal('0.01')
+
+# {name: rate}; every tax is charged on the subtotal
+TAX_RATES = getattr(settings, 'CHECKOUT_TAX_RATES', {'GST': '0.18'})
+# [(minimum subtotal, charge)]; the highest tier the subtotal reaches applies
+SHIPPING_RATES = getattr(settings, 'CHECKOUT_SHIPPING_RATES', [('0.00', '100.00')])
+
+GST_RATE = Decimal(TAX_RATES.get('GST', '0'))
+
+
+def money(amount):
+    return Decimal(amount).quantize(PAISA, rounding=ROUND_HALF_UP)
+
+
+@lru_cache(maxsize=1)
+def pricing_tables():
+    """(taxes, shipping) as tuples of Decimals; shipping sorted by threshold, highest first."""
+    taxes = tuple((name, Decimal(str(rate))) for name, rate in TAX_RATES.items())
+    shipping = tuple(sorted(
+        ((Decimal(str(minimum)), money(str(charge))) for minimum, charge in SHIPPING_RATES),
+        reverse=True
+    ))
+    return taxes, shipping
+
+
+def reload_pricing_tables():
+    pricing_tables.cache_clear()
+
+
+_shipping_table = {'version': None, 'zones': {}, 'charges': {}}
+_shipping_table_lock = threading.Lock()
+
+
+def _load_shipping_table(version):
+    charges = dict(ShippingZone.objects.values_list('id', 'courier_charge'))
+    zones = {
+        int(pincode): zone_id
+        for pincode, zone_id in PincodeZone.objects.values_list('pincode', 'zone_id').iterator(chunk_size=5000)
+        if pincode.isdigit()
+    }
+    _shipping_table.update(version=version, zones=zones, charges=charges)
+
+
+def shipping_table():
+    """This process's copy of the pincode table, reloaded if the admin changed it."""
+    version = get_shipping_table_version()
+    if _shipping_table['version'] != version:
+        with _shipping_table_lock:
+            if _shipping_table['version'] != version:
+                _load_shipping_table(version)
+    return _shipping_table
+
+
+def normalize_pincode(pincode):
+    """'560 001' / '560-001' -> 560001; None if it isn't a 6-digit pincode."""
+    digits = re.sub(r'\D', '', str(pincode or ''))
+    return int(digits) if len(digits) == 6 else None
+
+
+def zone_courier_charge(pincode):
+    """Courier charge for a destination pincode, or None if it isn't in a zone."""
+    pincode = normalize_pincode(pincode)
+    if pincode is None:
+        return None
+    table = shipping_table()
+    zone_id = table['zones'].get(pincode)
+    return table['charges'].get(zone_id) if zone_id is not None else None
+
+
+def delivery_address(user, address_id=None):
+    """The customer's chosen address (when it is theirs), else their latest one, else None."""
+    addresses = Address.objects.filter(user=user).order_by('-id')
+    if address_id and str(address_id).isdigit():
+        chosen = addresses.filter(id=address_id).first()
+        if chosen is not None:
+            return chosen
+    return addresses.first()
+
+
+def address_pincode(user, address_id=None):
+    """Postal code of delivery_address()."""
+    address = delivery_address(user, address_id)
+    return address.postal_code if address else None
+
+
+class Quote:
+    """Priced cart. taxes is a list of (name, rate, amount)."""
+
+    def __init__(self, subtotal, taxes, shipping):
+        self.subtotal = subtotal
+        self.taxes = taxes
+        self.tax_total = sum((amount for _, _, amount in taxes), Decimal('0.00'))
+        self.shipping = shipping
+        self.grand_total = subtotal + self.tax_total + shipping
+
+    @property
+    def amount_paise(self):
+        return int(self.grand_total * 100)
+
+    def as_dict(self):
+        return {
+            'subtotal': self.subtotal,
+            'taxes': [{'name': name, 'rate': rate, 'amount': amount} for name, rate, amount in self.taxes],
+            'tax_total': self.tax_total,
+            'shipping': self.shipping,
+            'grand_total': self.grand_total,
+        }
+
+    def __repr__(self):
+        return f'<Quote subtotal={self.subtotal} tax={self.tax_total} shipping={self.shipping} total={self.grand_total}>'
+
+
+def quote_subtotal(subtotal, pincode=None):
+    """
+    Quote from an already summed subtotal; an empty cart has no shipping.
+    With a pincode in the zone table its courier charge is used.
+    """
+    taxes, shipping_rates = pricing_tables()
+    subtotal = money(subtotal)
+    tax_lines = [(name, rate, money(subtotal * rate)) for name, rate in taxes]
+    shipping = Decimal('0.00')
+    if subtotal > 0:
+        shipping = zone_courier_charge(pincode) if pincode else None
+        if shipping is None:
+            shipping = next((charge for minimum, charge in shipping_rates if subtotal >= minimum), Decimal('0.00'))
+    return Quote(subtotal, tax_lines, money(shipping))
+
+
+def quote_lines(lines, pincode=None):
+    """lines is an iterable of (unit_price, quantity)."""
+    return quote_subtotal(sum((Decimal(price) * quantity for price, quantity in lines), Decimal('0.00')), pincode)
+
+
+def quote_cart(items, pincode=None):
+    """Quote CartItem / CartLine / buy-now items (anything with .product.price and .quantity)."""
+    return quote_lines(((item.product.price, item.quantity) for item in items), pincode)
+
+
+def quote_many(carts, pincodes=None):
+    """{key: lines} -> {key: Quote}, with lines as in quote_lines() and optional {key: pincode}."""
+    pincodes = pincodes or {}
+    return {key: quote_lines(lines, pincodes.get(key)) for key, lines in carts.items()}
+
+
+def quote_saved_carts(user_ids=None):
+    """
+    {user_id: Quote} for the saved (CartItem) carts of many users, with the
+    subtotals summed in a single grouped query and shipping to each customer's
+    latest address. user_ids=None quotes every cart.
+    """
+    items = CartItem.objects.all()
+    if user_ids is not None:
+        items = items.filter(user_id__in=list(user_ids))
+    subtotals = (
+        items.values('user_id')
+        .annotate(subtotal=Sum(
+            F('product__price') * F('quantity'),
+            output_field=DecimalField(max_digits=12, decimal_places=2)
+        ))
+        .order_by()
+    )
+    subtotals = list(subtotals)
+    # courier charge by each customer's latest address
+    pincodes = dict(
+        Address.objects.filter(user_id__in=[row['user_id'] for row in subtotals])
+        .order_by('id')
+        .values_list('user_id', 'postal_code')
+    )
+    return {
+        row['user_id']: quote_subtotal(row['subtotal'] or 0, pincodes.get(row['user_id']))
+        for row in subtotals
+    }
@@ -0,0 +1,146 @@
+# orders/tests.py
+
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, connection
+from django.test import TransactionTestCase
+
+from accounts.models import Order
+from products.models import Product
+from .inventory import InsufficientStock, decrement_stock
+from .models import CartItem
+from .payments import create_order_from_cart
+
+
+def retry_locked(fn):
+    """
+    Call fn(), again while SQLite answers "database table is locked".
+    The in-memory SQLite test database shares one cache between the threads'
+    connections and fails a conflicting write at once, where PostgreSQL or a
+    file-backed SQLite (busy timeout) would wait for the lock.
+    """
+    while True:
+        try:
+            return fn()
+        except OperationalError as exc:
+            if 'locked' not in str(exc):
+                raise
+            time.sleep(0.001)
+
+
+def race(buyers, buy):
+    """
+    Run buy(n) in `buyers` threads started together.
+    Returns (results, shortages); any other exception fails the caller's assert.
+    """
+    start = threading.Barrier(buyers)
+    results = []
+    short = []
+    errors = []
+
+    def run(n):
+        try:
+            start.wait()
+            results.append(retry_locked(lambda: buy(n)))
+        except InsufficientStock as exc:
+            short.append(exc)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(buyers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, short, errors
+
+
+class DecrementStockConcurrencyTests(TransactionTestCase):
+    """Many checkouts racing for the last units must never oversell."""
+
+    BUYERS = 20
+    STOCK = 5
+
+    def setUp(self):
+        influencer = get_user_model().objects.create_user(username='seller', password='x')
+        self.product = Product.objects.create(
+            influencer=influencer,
+            name='Last units',
+            description='',
+            price=100,
+            stock=self.STOCK
+        )
+
+    def _race(self, quantity):
+        def buy(n):
+            decrement_stock({self.product.id: quantity})
+            return quantity
+
+        sold, short, errors = race(self.BUYERS, buy)
+        self.assertEqual(errors, [])
+        return sold, short
+
+    def test_last_units_are_sold_once(self):
+        sold, short = self._race(1)
+
+        self.product.refresh_from_db()
+        self.assertGreaterEqual(self.product.stock, 0)
+        self.assertEqual(sum(sold), self.STOCK)
+        self.assertEqual(len(short), self.BUYERS - self.STOCK)
+        self.assertEqual(self.product.stock, self.STOCK - sum(sold))
+
+    def test_multi_unit_orders_never_overdraw(self):
+        sold, short = self._race(2)
+
+        self.product.refresh_from_db()
+        self.assertGreaterEqual(self.product.stock, 0)
+        self.assertLessEqual(sum(sold), self.STOCK)
+        self.assertEqual(self.product.stock, self.STOCK - sum(sold))
+        self.assertTrue(all(exc.available < exc.requested for exc in short))
+
+    def test_shortage_reports_what_is_left(self):
+        with self.assertRaises(InsufficientStock) as raised:
+            decrement_stock({self.product.id: self.STOCK + 1})
+
+        self.assertEqual(raised.exception.available, self.STOCK)
+        self.assertIn('Last units', str(raised.exception))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, self.STOCK)
+
+    def test_building_the_error_does_not_query(self):
+        with self.assertNumQueries(0):
+            InsufficientStock(self.product.id, 3, available=1, name='Last units')
+
+
+class CheckoutConcurrencyTests(TransactionTestCase):
+    """Two customers checking out the last unit at the same time: one order, no oversell."""
+
+    def setUp(self):
+        User = get_user_model()
+        influencer = User.objects.create_user(username='seller', password='x')
+        self.product = Product.objects.create(
+            influencer=influencer,
+            name='Last one',
+            description='',
+            price=100,
+            stock=1
+        )
+        self.customers = [User.objects.create_user(username=f'buyer{n}', password='x') for n in range(2)]
+        for customer in self.customers:
+            CartItem.objects.create(user=customer, product=self.product, quantity=1)
+
+    def test_last_unit_goes_to_one_checkout(self):
+        orders, short, errors = race(2, lambda n: create_order_from_cart(self.customers[n], address='Somewhere'))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(len(short), 1)
+        self.assertEqual(short[0].available, 0)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Order.objects.get().items.get().product_id, self.product.id)
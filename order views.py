@@ -6,64 +6,91 @@ from .forms import AddressForm
 from django.contrib import messages
 from django.http import HttpResponse
 
-import razorpay
+import hashlib
+import json
 from decimal import Decimal
-from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
 from django.db import transaction
+from .inventory import InsufficientStock, decrement_stock, hold_stock
+from .webhooks import enqueue_event
+from .flashsale import flash_sale_gate
+from .payments import (
+    GatewayUnavailable, PaymentVerificationError, checkout_fingerprint, checkout_notes,
+    create_order_from_cart, finalize_payment, get_gateway, submit_gateway_order, wait_gateway_order,
+)
+from .cart import get_cart_store, get_cart_totals, invalidate_cart_summary
+from .pricing import address_pincode, delivery_address, quote_cart
+from accounts.affiliate import get_session_affiliate_code, clear_session_affiliate_code
+from accounts.order_status import change_order_status
 
 
 
 
 
-@login_required
+# Cart views work for guests too; lines live in the cart store (session by default)
+# and are only written to CartItem at checkout or on the persist debounce.
 def add_to_cart(request, product_id):
     product = get_object_or_404(Product, id=product_id)
-    cart_item, created = CartItem.objects.get_or_create(user=request.user, product=product)
-    if not created:
-        cart_item.quantity += 1
-        cart_item.save()
+    get_cart_store(request).add(product)
     return redirect('view_cart')
 
 
-@login_required
 def view_cart(request):
-    cart_items = CartItem.objects.filter(user=request.user)
-    total = sum(item.total_price() for item in cart_items)
-    return render(request, 'cart.html', {'cart_items': cart_items, 'total': total})
+    cart = get_cart_store(request).build()
+    # same default address as checkout; guests / no address get the default courier rate
+    pincode = address_pincode(request.user) if request.user.is_authenticated else None
+    return render(request, 'cart.html', {
+        'cart_items': cart['cart_items'],
+        'total': cart['subtotal'],
+        'quote': quote_cart(cart['cart_items'], pincode=pincode),
+        'pincode': pincode,
+    })
 
 
 
-@login_required
+# item_id is the product id of the cart line (CartLine.id)
 def update_cart_item(request, item_id, action):
-    cart_item = get_object_or_404(CartItem, id=item_id, user=request.user)
+    store = get_cart_store(request)
+    line = store.lines().get(item_id)
+    if line is None:
+        return redirect('view_cart')
 
+    quantity = line['quantity']
     if action == 'increase':
-        cart_item.quantity += 1
-    elif action == 'decrease' and cart_item.quantity > 1:
-        cart_item.quantity -= 1
+        quantity += 1
+    elif action == 'decrease' and quantity > 1:
+        quantity -= 1
 
-    cart_item.save()
+    store.update_quantity(item_id, quantity)
     return redirect('view_cart')
 
 
-@login_required
 def remove_from_cart(request, item_id):
-    cart_item = get_object_or_404(CartItem, id=item_id, user=request.user)
     if request.method == 'POST':
-        cart_item.delete()
+        get_cart_store(request).remove(item_id)
     return redirect('view_cart')
 
 
 @login_required
 def buy_now(request, product_id):
     product = get_object_or_404(Product, id=product_id)
+    waiting_room = flash_sale_gate(request, [product])
+    if waiting_room is not None:
+        return waiting_room
     request.session['buy_now_product_id'] = product.id
     request.session['buy_now_quantity'] = 1
     return redirect('checkout')
 
 
+def session_buy_now(request):
+    """{product_id: quantity} of the buy-now checkout in progress, or None for a cart checkout."""
+    product_id = request.session.get('buy_now_product_id')
+    if not product_id:
+        return None
+    return {product_id: request.session.get('buy_now_quantity', 1)}
+
+
 
 
 
@@ -117,33 +144,19 @@ def delete_address(request, address_id):
 @login_required
 def confirm_order(request):
     user = request.user
+    get_cart_store(request).persist()
     cart_items = CartItem.objects.filter(user=user)
     address = Address.objects.filter(user=user).last()
 
-    order = Order.objects.create(user=user, address=address, total_amount=0)
-    total = 0
-
-    for item in cart_items:
-        product = item.product
-        if product.stock >= item.quantity:
-            product.stock -= item.quantity
-            product.save()
-        else:
-            return HttpResponse("Not enough stock for {}".format(product.name))
-
-        OrderItem.objects.create(
-            order=order,
-            product=product,
-            quantity=item.quantity,
-            price=product.price
-        )
-        total += item.quantity * product.price
+    try:
+        order = create_order_from_cart(user, address=address)
+    except ValueError as ve:
+        return HttpResponse(str(ve))
 
-    order.total_amount = total
-    order.save()
-    order.status = Order.COMPLETED
-    order.save()
+    change_order_status(order, Order.COMPLETED, changed_by=user)
     cart_items.delete()
+    invalidate_cart_summary(user)
+    get_cart_store(request).clear()
 
     return redirect('order_summary', order_id=order.id)
 
@@ -160,17 +173,16 @@ def place_order(request, product_id):
     # Assume quantity comes from POST data
     quantity = int(request.POST.get('quantity', 1))  # Default to 1 if not provided
 
-    if product.stock >= quantity:
-        product.stock -= quantity
-        product.save()
-        # Continue with order creation logic (save Order model etc.)
-
-        messages.success(request, f'Order placed successfully for {quantity} item(s)!')
-        return redirect('order_success_page')  # your success page
-    else:
+    try:
+        decrement_stock({product.id: quantity})
+    except ValueError:
         messages.error(request, 'Sorry, not enough stock available!')
         return redirect('product_list')
 
+    # Continue with order creation logic (save Order model etc.)
+    messages.success(request, f'Order placed successfully for {quantity} item(s)!')
+    return redirect('order_success_page')  # your success page
+
 
 from django.db.models import Sum
 
@@ -195,43 +207,6 @@ def rupees_to_paise(amount):
     # ensure Decimal to avoid floating mistakes
     return int( (Decimal(amount)).quantize(Decimal("0.01")) * 100 )
 
-def create_order_from_cart(user, address=None):
-    """
-    Create Order + OrderItems for the user's cart.
-    Returns (order, message) or raises Exception on stock problems.
-    """
-    cart_items = CartItem.objects.filter(user=user)
-    if not cart_items.exists():
-        raise ValueError("Cart is empty")
-
-    # Use atomic transaction to keep consistency
-    with transaction.atomic():
-        # Create order record with total 0 for now
-        order = Order.objects.create(user=user, address=address, total_amount=0, status=Order.PENDING)
-        total = Decimal('0.00')
-
-        for item in cart_items.select_related('product'):
-            product = item.product
-            if product.stock < item.quantity:
-                raise ValueError(f"Not enough stock for {product.name}")
-            # Reduce stock
-            product.stock -= item.quantity
-            product.save()
-
-            OrderItem.objects.create(
-                order=order,
-                product=product,
-                quantity=item.quantity,
-                price=product.price
-            )
-            total += Decimal(item.quantity) * Decimal(product.price)
-
-        order.total_amount = total
-        # keep as Pending until payment verified
-        order.save()
-        # don't delete cart_items here — we'll clear them after successful payment
-        return order
-
 # ---------- Checkout view creates a Razorpay order ----------
 @login_required
 def checkout(request):
@@ -265,47 +240,77 @@ def checkout(request):
             
             mock_item = MockCartItem(product, quantity)
             cart_items = [mock_item]
-            total_for_calculation = product.price * quantity
         else:
             messages.info(request, "Product not found for buy now.")
             return redirect('view_cart')
     else:
-        cart_items = CartItem.objects.filter(user=request.user)
-        if not cart_items.exists():
+        # flush the session cart to CartItem, then one query for lines + totals
+        get_cart_store(request).persist()
+        cart = get_cart_totals(request.user)
+        cart_items = cart['cart_items']
+        if not cart_items:
             messages.info(request, "Your cart is empty.")
             return redirect('view_cart')
-        total_for_calculation = sum(Decimal(item.product.price) * item.quantity for item in cart_items)
 
-    # compute total as Decimal
-    if is_buy_now:
-        subtotal = total_for_calculation
-    else:
-        subtotal = sum(Decimal(item.product.price) * item.quantity for item in cart_items)
-    
-    # Calculate GST (18% of subtotal)
-    gst_rate = Decimal('0.18')
-    gst_amount = subtotal * gst_rate
-    
-    # Fixed courier charge
-    courier_charge = Decimal('100.00')
-    
-    # Calculate grand total
-    grand_total = subtotal + gst_amount + courier_charge
-    
+    # flash-sale products: only shoppers admitted by the queue get through
+    waiting_room = flash_sale_gate(request, [item.product for item in cart_items])
+    if waiting_room is not None:
+        return waiting_room
+
+    # hold the stock while the customer is on the payment screen
+    try:
+        quantities = {}
+        for item in cart_items:
+            quantities[item.product.id] = quantities.get(item.product.id, 0) + item.quantity
+        hold_stock(request.user, quantities)
+    except InsufficientStock as e:
+        messages.error(request, str(e))
+        return redirect('view_cart')
+
+    # the page is priced for one delivery address: ?address_id when the customer
+    # picked one, else their latest; paymenthandler receives the same one
+    selected_address = delivery_address(request.user, request.GET.get('address_id'))
+
+    # subtotal, GST and courier charge from the pricing engine (the cart page quotes the same way);
+    # the courier charge depends on the delivery pincode
+    quote = quote_cart(cart_items, pincode=selected_address.postal_code if selected_address else None)
+    subtotal = quote.subtotal
+    gst_amount = quote.tax_total
+    courier_charge = quote.shipping
+    grand_total = quote.grand_total
+
     # Convert grand total to paise for Razorpay (since we want to charge the full amount including GST and courier)
-    total_paise = rupees_to_paise(grand_total)
+    total_paise = quote.amount_paise
+
+    # Razorpay order (server-side), reused across refreshes until the cart / total changes.
+    # It runs on the gateway thread pool while we load addresses below, so the
+    # page costs max(gateway, DB) instead of their sum.
+    gateway = get_gateway()
+    affiliate_code = get_session_affiliate_code(request)
+    fingerprint = checkout_fingerprint(
+        [(item.product.id, item.quantity, item.product.price) for item in cart_items],
+        grand_total,
+        address_id=selected_address.id if selected_address else None,
+        affiliate_code=affiliate_code
+    )
+    gateway_future = submit_gateway_order(
+        request.user,
+        fingerprint,
+        total_paise,
+        gateway=gateway,
+        notes=checkout_notes(request.user, selected_address, affiliate_code, buy_now=session_buy_now(request))
+    )
 
     # get addresses for user (to let them choose)
-    addresses = request.user.addresses.all()
+    addresses = list(request.user.addresses.all())
     address_form = AddressForm()
 
-    # create a Razorpay order (server-side)
-    client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-    razorpay_order = client.order.create(dict(
-        amount=total_paise,
-        currency='INR',
-        payment_capture='1'  # auto-capture
-    ))
+    try:
+        razorpay_order_id = wait_gateway_order(gateway_future)
+    except GatewayUnavailable:
+        # gateway slow / down: still show the order, just without the pay button
+        razorpay_order_id = None
+        messages.error(request, "Payments are temporarily unavailable. Please try again in a minute.")
 
     context = {
         'cart_items': cart_items,
@@ -313,10 +318,13 @@ def checkout(request):
         'gst_amount': gst_amount,
         'courier_charge': courier_charge,
         'grand_total': grand_total,
+        'quote': quote,
         'is_buy_now': is_buy_now,
-        'razorpay_order_id': razorpay_order['id'],
-        'razorpay_key_id': settings.RAZORPAY_KEY_ID,
+        'razorpay_order_id': razorpay_order_id,
+        'razorpay_key_id': gateway.key_id,
+        'payment_unavailable': razorpay_order_id is None,
         'addresses': addresses,
+        'selected_address': selected_address,
         'address_form': address_form,
     }
     return render(request, 'checkout.html', context)
@@ -354,7 +362,6 @@ def paymenthandler(request):
     if not (payment_id and razorpay_order_id and signature):
         return HttpResponse("Missing payment parameters", status=400)
 
-    client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
     params_dict = {
         'razorpay_order_id': razorpay_order_id,
         'razorpay_payment_id': payment_id,
@@ -363,35 +370,41 @@ def paymenthandler(request):
 
     try:
         # verify signature
-        client.utility.verify_payment_signature(params_dict)
-    except Exception as e:
+        get_gateway().verify_payment_signature(params_dict)
+    except PaymentVerificationError as e:
         # signature verification failed
         return HttpResponse("Payment verification failed: " + str(e), status=400)
 
-    # signature ok → create Order from cart and mark completed
+    # signature ok → create Order from cart and mark completed (once per payment)
     try:
+        buy_now = session_buy_now(request)
         address = None
         if selected_address_id:
             address = get_object_or_404(Address, id=selected_address_id, user=request.user)
 
-        # create order and items (this will reserve stock)
-        order = create_order_from_cart(request.user, address=address)
+        order, created = finalize_payment(
+            request.user,
+            razorpay_order_id,
+            payment_id,
+            address=address,
+            affiliate_code=get_session_affiliate_code(request),
+            lines=buy_now
+        )
+        if order.user_id != request.user.id:
+            return HttpResponse("Payment belongs to another account", status=403)
 
-        # mark order paid/completed
-        order.status = Order.COMPLETED
-        order.save()
+        # clear user's cart (a buy-now order leaves it alone)
+        if not buy_now:
+            get_cart_store(request).clear()
 
-        # clear user's cart
-        CartItem.objects.filter(user=request.user).delete()
-        
         # clear buy_now session data if it exists
         if 'buy_now_product_id' in request.session:
             del request.session['buy_now_product_id']
         if 'buy_now_quantity' in request.session:
             del request.session['buy_now_quantity']
 
-        # Optionally, store razorpay ids somewhere (extend Order model if you like)
-        # e.g., order.razorpay_payment_id = payment_id ; order.save()
+        # attribution is one order per click
+        clear_session_affiliate_code(request)
 
         # show the order summary page
         return redirect('order_summary', order_id=order.id)
@@ -401,6 +414,35 @@ def paymenthandler(request):
     except Exception as ex:
         return HttpResponse("Error creating order: " + str(ex), status=500)
 
+# ---------- Gateway webhook: verify + enqueue only, workers finalize ----------
+@csrf_exempt
+def payment_webhook(request):
+    """
+    Razorpay webhook (subscribe to order.paid). Verifies the signature and
+    stores the event in the PaymentEvent queue; orders.webhooks workers create
+    the order, so this responds in milliseconds even if the browser never
+    reaches paymenthandler.
+    """
+    if request.method != "POST":
+        return HttpResponse("Invalid request method", status=405)
+
+    try:
+        get_gateway().verify_webhook_signature(request.body, request.headers.get('X-Razorpay-Signature', ''))
+    except PaymentVerificationError as e:
+        return HttpResponse("Webhook verification failed: " + str(e), status=400)
+
+    try:
+        payload = json.loads(request.body)
+        event_type = payload['event']
+    except (ValueError, KeyError):
+        return HttpResponse("Malformed webhook body", status=400)
+
+    event_id = request.headers.get('X-Razorpay-Event-Id') or hashlib.sha256(request.body).hexdigest()
+    enqueue_event(event_id, event_type, payload)
+
+    # 200 for duplicates too, otherwise the gateway keeps redelivering
+    return JsonResponse({'status': 'ok'})
+
 # ---------- Order summary ----------
 @login_required
 def order_summary(request, order_id):
@@ -0,0 +1,177 @@
+# orders/webhooks.py
+#
+# Gateway webhooks: the view verifies the signature and durably enqueues a
+# PaymentEvent row (a single INSERT), and a pool of workers finalizes orders
+# from the queue with retries and a dead-letter state. Run the workers with
+#     python manage.py run_payment_workers
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from accounts.models import PaymentEvent
+from .models import Address
+from .payments import buy_now_lines, finalize_payment
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 30  # seconds; doubled on each attempt
+LOCK_TIMEOUT = timedelta(minutes=5)  # a processing row older than this is assumed orphaned
+
+# Only order.paid carries the gateway order (and the checkout notes on it);
+# a payment.captured payment entity has no notes of ours, and Razorpay sends
+# order.paid for the same capture, so other events are acknowledged and skipped.
+FINALIZE_EVENTS = ('order.paid',)
+
+
+class PermanentEventError(Exception):
+    """The event can never succeed (bad payload, unknown customer, no stock); dead-letter it now."""
+
+
+def enqueue_event(event_id, event_type, payload):
+    """Insert the event once; a redelivered webhook with the same id is ignored."""
+    try:
+        PaymentEvent.objects.create(event_id=event_id, event_type=event_type, payload=payload)
+        return True
+    except IntegrityError:
+        return False
+
+
+def claim_events(batch_size=10):
+    """
+    Lock a batch of due events for this worker. SKIP LOCKED lets several
+    workers poll the same table without handing out the same row twice.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = list(
+            PaymentEvent.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=PaymentEvent.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        # rows a crashed worker left behind
+        due += list(
+            PaymentEvent.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=PaymentEvent.PROCESSING, locked_at__lt=now - LOCK_TIMEOUT)[:batch_size]
+        )
+        if due:
+            PaymentEvent.objects.filter(id__in=[event.id for event in due]).update(
+                status=PaymentEvent.PROCESSING,
+                locked_at=now
+            )
+    return due
+
+
+def handle_event(event):
+    """
+    Finalize the order for a paid gateway order (no-op if paymenthandler
+    already did), with the address, affiliate code and buy-now line checkout
+    stored in the gateway order's notes.
+    """
+    if event.event_type not in FINALIZE_EVENTS:
+        return
+
+    try:
+        payment = event.payload['payload']['payment']['entity']
+        razorpay_order_id = payment['order_id']
+        payment_id = payment['id']
+        notes = event.payload['payload']['order']['entity'].get('notes') or {}
+        user = get_user_model().objects.get(id=notes['user_id'])
+        lines = buy_now_lines(notes)
+    except (KeyError, TypeError, ValueError, get_user_model().DoesNotExist) as e:
+        raise PermanentEventError(f'Cannot map event to a customer: {e!r}')
+
+    address = None
+    if notes.get('address_id'):
+        address = Address.objects.filter(id=notes['address_id'], user=user).first()
+
+    try:
+        finalize_payment(
+            user,
+            razorpay_order_id,
+            payment_id,
+            address=address,
+            affiliate_code=notes.get('affiliate_code') or None,
+            lines=lines
+        )
+    except ValueError as e:
+        # stock problem or empty cart: retrying won't help, it needs a refund
+        raise PermanentEventError(str(e))
+
+
+def process_event(event):
+    try:
+        handle_event(event)
+    except PermanentEventError as e:
+        logger.error('Payment event %s dead-lettered: %s', event.event_id, e)
+        PaymentEvent.objects.filter(id=event.id).update(
+            status=PaymentEvent.DEAD,
+            attempts=event.attempts + 1,
+            last_error=str(e),
+            locked_at=None
+        )
+    except Exception as e:
+        attempts = event.attempts + 1
+        dead = attempts >= MAX_ATTEMPTS
+        logger.warning('Payment event %s failed (attempt %s): %s', event.event_id, attempts, e)
+        PaymentEvent.objects.filter(id=event.id).update(
+            status=PaymentEvent.DEAD if dead else PaymentEvent.PENDING,
+            attempts=attempts,
+            last_error=repr(e),
+            locked_at=None,
+            next_attempt_at=timezone.now() + timedelta(seconds=RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        )
+    else:
+        PaymentEvent.objects.filter(id=event.id).update(
+            status=PaymentEvent.DONE,
+            attempts=event.attempts + 1,
+            locked_at=None,
+            processed_at=timezone.now()
+        )
+
+
+def process_pending_events(batch_size=10):
+    """Process one batch; returns how many events were handled. Handy for tests and cron."""
+    events = claim_events(batch_size)
+    for event in events:
+        process_event(event)
+    return len(events)
+
+
+def run_payment_workers(concurrency=4, poll_interval=1.0, stop_event=None):
+    """
+    Run `concurrency` worker threads until stop_event is set.
+    Started by the run_payment_workers management command, not from a web worker.
+    """
+    stop_event = stop_event or threading.Event()
+
+    def worker():
+        while not stop_event.is_set():
+            close_old_connections()
+            try:
+                handled = process_pending_events()
+            except Exception:
+                logger.exception('Payment worker crashed while claiming events')
+                handled = 0
+            if not handled:
+                stop_event.wait(poll_interval)
+        close_old_connections()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='payment-worker') as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+        try:
+            while not stop_event.is_set():
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            stop_event.set()
@@ -16,6 +16,18 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+class ProductQuerySet(models.QuerySet):
+    def with_available_stock(self):
+        """Annotate flash-sale shard totals so available_stock needs no query per product."""
+        shard_stock = (
+            StockShard.objects.filter(product=models.OuterRef('pk'))
+            .values('product')
+            .annotate(total=models.Sum('stock'))
+            .values('total')
+        )
+        return self.annotate(shard_stock=models.Subquery(shard_stock))
+
+
 class Product(models.Model):
     influencer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
@@ -23,6 +35,8 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True,blank=True)
     stock = models.PositiveIntegerField()
+    # Units held by checkouts in progress (sum of StockHold.quantity); see orders/inventory.py
+    reserved = models.PositiveIntegerField(default=0)
     image = models.ImageField(upload_to='product_images/', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     product_type = models.CharField(max_length=20, choices=[
@@ -36,10 +50,61 @@ class Product(models.Model):
     is_hidden = models.BooleanField(default=False, help_text='Hide product from listings')
     is_trending = models.BooleanField(default=False)
 
+    # Flash sale: stock is sold from StockShard rows behind an admission queue (orders/flashsale.py)
+    is_flash_sale = models.BooleanField(default=False)
+    flash_sale_started_at = models.DateTimeField(blank=True, null=True)
+
+    objects = ProductQuerySet.as_manager()
+
+    @property
+    def available_stock(self):
+        """Units a shopper can still buy. Use Product.objects.with_available_stock() for lists."""
+        if self.is_flash_sale:
+            if hasattr(self, 'shard_stock'):
+                shard_stock = self.shard_stock
+            else:
+                shard_stock = self.stock_shards.aggregate(total=models.Sum('stock'))['total']
+            if shard_stock is not None:
+                return shard_stock
+        # no shards: not actually selling from them (see orders/flashsale.py)
+        return max(self.stock - self.reserved, 0)
+
     def __str__(self):
         return self.name
 
 
+class StockShard(models.Model):
+    """Slice of a flash-sale product's stock; buyers are spread over shards to avoid one hot row."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_shards')
+    shard = models.PositiveSmallIntegerField()
+    stock = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'shard')
+
+    def __str__(self):
+        return f"{self.product.name} shard {self.shard}: {self.stock}"
+
+
+class StockHold(models.Model):
+    """Stock set aside for one customer's checkout until expires_at."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_holds')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='stock_holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'product')
+        indexes = [
+            models.Index(fields=['expires_at']),  # sweeper
+            models.Index(fields=['product', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} holds {self.quantity} × {self.product.name} until {self.expires_at:%H:%M}"
+
+
 
 
 
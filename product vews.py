@@ -10,27 +10,18 @@ from orders.models import WishlistItem, OrderItem, Order
 from django.contrib import messages
 from django.db.models import Avg,  Sum
 from django.http import HttpResponse
+from django.views.decorators.http import condition
+from accounts.affiliate import affiliate_links_etag
 
 
 @login_required
 def influencer_product_list(request):
     products = Product.objects.filter(influencer=request.user)
 
-    # Get affiliate relationships for the influencer's products
+    # Get affiliate links for the influencer (cached per influencer version stamp)
     try:
-        from accounts.models import AffiliateRelationship
-        affiliate_relationships = AffiliateRelationship.objects.filter(
-            influencer=request.user,
-            is_active=True
-        ).select_related('product')
-
-        # Create a list of dictionaries for affiliate links
-        affiliate_links_list = []
-        for relationship in affiliate_relationships:
-            affiliate_links_list.append({
-                'product_id': relationship.product.id,
-                'affiliate_link': relationship.affiliate_link
-            })
+        from accounts.affiliate import get_affiliate_links
+        affiliate_links_list = get_affiliate_links(request.user.id)
     except ImportError:
         # Fallback if AffiliateRelationship model doesn't exist
         affiliate_links_list = []
@@ -61,7 +52,13 @@ def edit_product(request, product_id):
     if request.method == 'POST':
         form = ProductForm(request.POST, request.FILES, instance=product)
         if form.is_valid():
-            form.save()
+            # only the edited fields: stock / reserved move under concurrent checkouts
+            if form.changed_data:
+                form.save(commit=False).save(update_fields=form.changed_data)
+            # Product names are part of the cached affiliate link lists
+            from accounts.models import AffiliateRelationship, bump_affiliate_links_version
+            for influencer_id in AffiliateRelationship.objects.filter(product=product).values_list('influencer_id', flat=True):
+                bump_affiliate_links_version(influencer_id)
             return redirect('influencer_product_list')
     else:
         form = ProductForm(instance=product)
@@ -151,7 +148,7 @@ def influencer_sold_products(request):
     # Get all completed orders containing products from this influencer
     order_items = OrderItem.objects.filter(
         product__influencer=request.user,
-        order__status='Completed'
+        order__status__in=Order.PAID_STATUSES
     ).select_related('order', 'product').order_by('-order__created_at')
 
     # Prepare sold products data
@@ -282,11 +279,15 @@ def generate_affiliate_link(request, product_id):
     # Get or create the affiliate relationship
     try:
         from accounts.models import AffiliateRelationship
+        code = uuid.uuid4().hex
         affiliate_relationship, created = AffiliateRelationship.objects.get_or_create(
             influencer=request.user,
             product=product,
             defaults={
-                'affiliate_link': f"https://lumoskart.com/affiliate/{request.user.id}/{product.id}/{uuid.uuid4()}",
+                'code': code,
+                'affiliate_link': request.build_absolute_uri(
+                    reverse('affiliate_redirect', args=[request.user.id, product.id, code])
+                ),
                 'is_active': True
             }
         )
@@ -299,27 +300,17 @@ def generate_affiliate_link(request, product_id):
 
 
 @login_required
+@condition(etag_func=affiliate_links_etag)
 def get_affiliate_links_for_influencer(request):
-    """Get all affiliate links for the current influencer"""
+    """Get all affiliate links for the current influencer (304 when the If-None-Match ETag still matches)"""
     if request.user.user_type != 'influencer':
         return redirect('home')
 
     try:
-        from accounts.models import AffiliateRelationship
-        affiliate_relationships = AffiliateRelationship.objects.filter(
-            influencer=request.user,
-            is_active=True
-        ).select_related('product')
-
-        affiliate_data = []
-        for relationship in affiliate_relationships:
-            affiliate_data.append({
-                'product_id': relationship.product.id,
-                'product_name': relationship.product.name,
-                'affiliate_link': relationship.affiliate_link,
-            })
-
-        return JsonResponse({'affiliate_links': affiliate_data})
+        from accounts.affiliate import get_affiliate_links
+        response = JsonResponse({'affiliate_links': get_affiliate_links(request.user.id)})
+        response['Cache-Control'] = 'private, no-cache'
+        return response
     except ImportError:
         # Return an empty list if AffiliateRelationship model doesn't exist
         return JsonResponse({'affiliate_links': []})
@@ -328,5 +319,22 @@ def get_affiliate_links_for_influencer(request):
 
 
 
+def affiliate_redirect(request, influencer_id, product_id, code):
+    """Landing point for an influencer's affiliate link: log the click, stamp the session, show the product"""
+    from accounts.models import AffiliateRelationship
+    from accounts.affiliate import record_click
+
+    relationship = get_object_or_404(
+        AffiliateRelationship,
+        code=code,
+        influencer_id=influencer_id,
+        product_id=product_id,
+        is_active=True
+    )
+    record_click(request, relationship)
+
+    return redirect('product_detail', product_id=product_id)
+
+
 def affliated(request):
     return render(request,'affliated.html')